@@ -1,7 +1,5 @@
 var urlParams = new URLSearchParams(window.location.search);
 
-var img_as = document.querySelectorAll('a.zimg');
-var span_dls = document.querySelectorAll('span.download');
 var sections = document.getElementsByClassName('section');
 var pag_div = document.getElementById('pagination');
 var all_lis = pag_div.getElementsByTagName('li');
@@ -125,7 +123,6 @@ function clearLoading(el) {
 function imgLoadCb() {
     this.style.opacity = 1;
     clearLoading(this);
-    delete this.dataset.src;
 }
 
 function imgErrorCb() {
@@ -134,34 +131,64 @@ function imgErrorCb() {
 }
 
 /**
- * Returns a promise on an event listener
- * @param {Element} el Element
- * @param {String} typ Event listener type
- * @param {Function} fnc Function to run on event
- * @returns {Promise}
+ * Binds image, lightbox and download handlers for a section once its items are in the page.
+ * Thumbnails use native lazy loading, so they only load once their section is shown.
+ * @param {Element} sect Section div
  */
-function createEventPromise(el, typ, fnc) {
-    return new Promise(function(res, _rej) {
-        el.addEventListener(typ, function(evt) {
-            fnc.call(this, evt);
-            res(el);
-        }, {once: true});
-    });
-}
+function initSection(sect) {
+    for (let img of sect.querySelectorAll('a.zimg > img')) {
+        img.addEventListener(transitionEvent, transitionEndCb, {once: true});
+
+        if (img.complete && img.naturalWidth) {
+            imgLoadCb.call(img);
+            continue;
+        }
+        img.addEventListener('error', imgErrorCb, {once: true});
+        img.addEventListener('load', imgLoadCb, {once: true});
+    }
+
+    for (let sp of sect.querySelectorAll('span.download')) {
+        sp.onclick = runDownload;
+    }
 
-function loadNext(dest) {
-    var next_div = getSect(dest);
-    if (!next_div) return;
+    for (let a of sect.querySelectorAll('a.zimg')) {
+        new window.Luminous(a, lum_opt);
+    }
+}
 
-    var next_datasrc = next_div.querySelectorAll('img[data-src]');
+var section_loads = {};
 
-    for (let idata of next_datasrc) {
-        idata.addEventListener('error', imgErrorCb, {once: true});
-        idata.addEventListener('load', imgLoadCb, {once: true});
-        idata.addEventListener(transitionEvent, transitionEndCb, {once: true});
+/**
+ * Fetches the items of a section written as a separate file, the first time it is needed.
+ * @param {Number} idx Section number
+ * @returns {Promise}
+ */
+function loadSection(idx) {
+    var sect = getSect(idx);
+    if (!sect || !sect.dataset.src) {
+        return Promise.resolve(sect);
+    }
 
-        idata.src = idata.dataset.src;
+    if (!section_loads[idx]) {
+        section_loads[idx] = fetch(sect.dataset.src)
+        .then(response => {
+            if (!response.ok) throw new Error(`${response.status} loading ${sect.dataset.src}`);
+            return response.text();
+        })
+        .then(html => {
+            sect.innerHTML = html;
+            delete sect.dataset.src;
+            initSection(sect);
+            return sect;
+        })
+        .catch(e => {
+            console.error(e);
+            delete section_loads[idx];
+            return sect;
+        });
     }
+
+    return section_loads[idx];
 }
 
 function swap(idx, addHist = true) {
@@ -203,43 +230,8 @@ function swap(idx, addHist = true) {
     window.scrollTo(0, 0);
     dest_div.style.display = null;
 
-    //probably has an issue if navigating too fast
-    var target_new = dest_div.querySelectorAll('a.zimg > [data-src]');
-    var imgs_new = target_new.length;
-
-    if (imgs_new === 0) {
-        loadNext(dest + 1);
-    }
-    else {
-        var target_all = dest_div.querySelectorAll('a.zimg > img, a.zimg > video');
-        var imgs_total = target_all.length;
-        var imgs_loaded = imgs_total - imgs_new;
-
-        for (let idata of target_new) {
-            var promise_error = createEventPromise(idata, 'error', imgErrorCb);
-            var promise_load = createEventPromise(idata, 'load', imgLoadCb);
-            var _promise_trans = createEventPromise(idata, transitionEvent, transitionEndCb);
-
-            promise_error.then(el => {
-                imgs_loaded++;
-                console.log('error', el);
-                if (imgs_loaded === imgs_total) {
-                    //this will not load next on error
-                    loadNext(dest + 1);
-                }
-            });
-            //Promise.all([promise_load, promise_trans]).then(_els => {
-            promise_load.then(_els => {
-                imgs_loaded++;
-                if (imgs_loaded === imgs_total) {
-                    // is this scope wrong?
-                    loadNext(dest + 1);
-                }
-            });
-
-            idata.src = idata.dataset.src;
-        }
-    }
+    // the next section is fetched ahead, its thumbnails still wait until it is shown
+    loadSection(dest).then(() => loadSection(dest + 1));
 
     if (sections.length > 1) {
         if (dest === 1) {
@@ -266,8 +258,6 @@ function swap(idx, addHist = true) {
     }
 }
 
-swap();
-
 for (let lia of pag_lias) {
     let dest = lia.dataset.sectionid;
     let dest_id;
@@ -320,10 +310,6 @@ var runDownload = function() {
     downloadResource(url);
 };
 
-for (let sp of span_dls) {
-    sp.onclick = runDownload;
-}
-
 var make_vid = function() {
     var w = document.querySelector('.lum-opening img.lum-img');
     if (!w) return;
@@ -347,12 +333,16 @@ var cap_fn = function(trigger) {
     return trigger.querySelector('div.txt').innerText;
 };
 
-var opt = {caption: cap_fn, onOpen: make_vid};
+var lum_opt = {caption: cap_fn, onOpen: make_vid};
 
-for (let a of img_as) {
-    new window.Luminous(a, opt);
+for (let sect of sections) {
+    if (!sect.dataset.src) {
+        initSection(sect);
+    }
 }
 
+swap();
+
 document.addEventListener("keydown", function(event) {
     if (event.defaultPrevented) return;
     switch (event.key) {
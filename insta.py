@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 """Fetch data from instagram and create custom HTML pages."""
+
+from __future__ import annotations
 #from zmq.tests.test_security import USER
 
 __version__ = 1.1
@@ -8,15 +10,22 @@ DEFAULT_LOGLEVEL = 'INFO'
 
 MAX_PAGES = 50
 MAX_IMGS = 500
+IMG_WORKERS = 8
+USER_WORKERS = 4
+DETAILS_WORKERS = 4
+DETAILS_QUEUE = 100
+
+SYNC_MODES = ('auto', 'new', 'older', 'full')
+RANK_KEYS = ('likes', 'views', 'recent', 'likes_per_day')
 
 #RELOAD = False
 
 MAX_CAPTION = 275  # TODO better in html?
 
 
-from my_utils.parsing import parser_init
-
 def parse_args():
+    from my_utils.parsing import parser_init
+
     parser = parser_init(
         description=__doc__,
         usage='%(prog)s [options] username [...]',
@@ -25,7 +34,7 @@ def parse_args():
     )
 
     parser.add_argument(
-        'username', nargs='+', type=str,
+        'username', nargs='*', type=str,
         help='Instagram username'
     )
 
@@ -39,6 +48,21 @@ def parse_args():
         '-n', '--no-save-imgs', action='store_true',
         help='Do not save thumbnails, use instagram URLs'
     )
+    grp_cache.add_argument(
+        '--gc-thumbs', action='store_true',
+        help='Delete thumbnails not used by any cached media'
+    )
+    grp_cache.add_argument(
+        '-R', '--render', action='store_true',
+        help='Only rebuild HTML from the cache, without logging in or sending any request\n'
+             '(every cached user when none are given)'
+    )
+    grp_cache.add_argument(
+        '-y', '--sync', choices=SYNC_MODES, default='auto', metavar='<mode>',
+        help='How to update cached media (default: %(default)s)\nChoices: {%(choices)s}\n'
+             'new: only posts newer than the cache, older: continue from the saved cursor,\n'
+             'full: fetch from the first page, auto: new, then older if under the image limit'
+    )
 
     grp_limits = parser.add_argument_group(title='Limits')
 
@@ -50,6 +74,18 @@ def parse_args():
         '-i', '--max-images', type=int, default=MAX_IMGS, metavar='<num>',
         help='Max images to display in HTML (default: %(default)d)'
     )
+    grp_limits.add_argument(
+        '-w', '--img-workers', type=int, default=IMG_WORKERS, metavar='<num>',
+        help='Concurrent thumbnail downloads (default: %(default)d)'
+    )
+    grp_limits.add_argument(
+        '-u', '--user-workers', type=int, default=USER_WORKERS, metavar='<num>',
+        help='Users to scrape in parallel (default: %(default)d)'
+    )
+    grp_limits.add_argument(
+        '--http2', action='store_true',
+        help='Send requests over HTTP/2 where offered (needs httpx[http2])'
+    )
 
     grp_output = parser.add_argument_group(title='Output')
 
@@ -62,9 +98,29 @@ def parse_args():
         '-r', '--rows', type=int, default=4, metavar='<num>',
         help='Max rows for images in HTML (default: %(default)d)'
     )
+    grp_output.add_argument(
+        '-k', '--rank', choices=RANK_KEYS, default='likes', metavar='<key>',
+        help='Order of images in HTML (default: %(default)s)\nChoices: {%(choices)s}'
+    )
+    grp_output.add_argument(
+        '-p', '--paged', action='store_true',
+        help='Write a small page plus one file per section, each fetched when it is opened'
+    )
+    grp_output.add_argument(
+        '--report', type=str, metavar='<file>',
+        help='Write a JSON report of request, cache and stage metrics for the run'
+    )
+    grp_output.add_argument(
+        '--metrics-file', type=str, metavar='<file>',
+        help='Write the run metrics in Prometheus textfile format'
+    )
+    grp_output.add_argument(
+        '--profile', type=str, metavar='<dir>',
+        help='Profile CPU and allocations of each stage per user, writing pstats files and a summary to <dir>'
+    )
     grp_output.add_argument(
         '-g', '--get-location', action='store_true',
-        help='Fetch location data (takes longer)'
+        help='Fetch location data (one extra request per post, cached and run alongside paging)'
     )
 
     return parser.parse_args()
@@ -74,24 +130,50 @@ if __name__ == '__main__':
     ARGS = parse_args()
 
 
+import cProfile
 import hashlib
+import heapq
+import io
 import json
 import math
 import os
 import pickle
+import pstats
+import queue
 import re
-import requests
+import sqlite3
+import tempfile
+import threading
 import time
-from datetime import datetime
+import tracemalloc
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from glob import glob
 from mimetypes import guess_extension
 from pathlib import Path
 from pprint import pformat
-from typing import Dict, List, Union, Optional
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Union, Optional
+from urllib.parse import urlsplit
 
-from jinja2 import Environment, FileSystemLoader
 from my_utils.logs import log_init
 
+if TYPE_CHECKING:
+    from jinja2 import Environment
+    from requests.adapters import BaseAdapter
+
+try:
+    import fcntl
+except ImportError:  # no flock, locks are skipped and one process at a time is assumed
+    fcntl = None
+
+# imported when a scraper is made, rendering from the cache never loads the network stack
+requests = None
+
 # todo can I just do this instead? causes requests to show
 # import logging
 # logging.basicConfig(level=logging.DEBUG)
@@ -115,14 +197,38 @@ SLEEP_DELAY = 1.1
 SLEEP_DELAY_IMG = 0.1
 CONNECT_TIMEOUT = 3
 MAX_RETRIES = 3
+MAX_THROTTLE_RETRIES = 6
 RETRY_DELAY = 2
 
+# requests per second each endpoint class starts at, adjusted by AIMD within [FLOOR, CEILING] times that
+ENDPOINT_RATES = {
+    'profile': 1 / SLEEP_DELAY,
+    'graphql': 1 / SLEEP_DELAY,
+    'details': 1 / SLEEP_DELAY_IMG,
+    'image': 1 / SLEEP_DELAY_IMG
+}
+ENDPOINT_BURST = 1
+RATE_INCREASE = 0.05
+RATE_BACKOFF = 0.5
+RATE_FLOOR = 1 / 16
+RATE_CEILING = 2
+CHUNK_SIZE = 64 * 1024
+# rest of a profile page read after its sharedData to keep the connection, a longer one is closed instead
+PROFILE_DRAIN_MAX = 512 * 1024
+
+# connections kept per host on top of the download workers, for paging and profile requests
+POOL_SLACK = 2
+
 BASE_URL = 'https://www.instagram.com/'
+BASE_HOST = urlsplit(BASE_URL).netloc
 GQL_URL = BASE_URL + 'graphql/query/?query_hash=42323d64886122307be10013ad2dcc44&variables={}'
 GQL_VARS_FIRST = '{{"id":"{0}","first":50}}'
 GQL_VARS = '{{"id":"{0}","first":50,"after":"{1}"}}'
 
 LOGIN_URL = BASE_URL + 'accounts/login/ajax/'
+# where instagram redirects requests of a session it no longer accepts
+LOGIN_PATH = '/accounts/login'
+CHECKPOINT_PATH = '/challenge'
 VIEW_MEDIA_URL = BASE_URL + 'p/{0}/?__a=1'
 
 #https://www.instagram.com/user/?__a=1 ? seems to be working again. rate limited?
@@ -131,7 +237,11 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, li
 #USER_AGENT = 'Instagram 123.0.0.21.114 (iPhone; CPU iPhone OS 11_4 like Mac OS X; en_US; en-US; scale=2.00; 750x1334) AppleWebKit/605.1.15'
 STORIES_UA = 'Instagram 123.0.0.21.114 (iPhone; CPU iPhone OS 11_4 like Mac OS X; en_US; en-US; scale=2.00; 750x1334) AppleWebKit/605.1.15'
 
+SESSION_NAME = 'session'
+# only the cookies were saved before the whole session, they are read when there is no saved session yet
 COOKIE_NAME = 'cookies'
+# authentications per run, a session that keeps failing is more likely a checkpoint than an expiry
+MAX_AUTHS = 3
 
 CREDENTIALS_FILE = Path('./.creds')
 
@@ -148,32 +258,808 @@ IMG_DIR = HTML_DIR + IMGS_DIRNAME
 THUMB_DIR = IMG_DIR + THUMB_DIRNAME
 
 HTML_TEMPLATE = 'main'
+SECTION_TEMPLATE = 'section'
+SECTIONS_DIRNAME = 'sections/'
+DAY_SECS = 24 * 60 * 60
+
+SHARED_DATA_START = b'window._sharedData = '
+SHARED_DATA_END = b';</script>'
+
+HTTP_CACHE_NAME = 'http.sqlite'
+HTTP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# seconds a cached response is used without asking the server, per url class; others are never cached
+HTTP_CACHE_TTLS = {
+    'profile': 10 * 60,
+    'details': 24 * 60 * 60
+}
+
+THUMB_INDEX_NAME = 'thumbs.sqlite'
+THUMB_MIN_BYTES = 1
+RE_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+STORE_EXT = '.db'
+SQL_BATCH = 500
+
+# upper bounds in seconds of the duration histograms
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+METRICS_PREFIX = 'insta_'
+
+# stages --profile covers, and how much of each profile and allocation diff its summary lists
+PROFILE_STAGES = ('auth', 'profile', 'pages', 'details_wait', 'cache_load', 'thumbnails', 'html')
+PROFILE_TOP = 20
+PROFILE_FRAMES = 1
+
+# seconds to wait on a database another process is writing
+SQLITE_TIMEOUT = 30
+LOCK_EXT = '.lock'
+
+# mkstemp files are private, what we rename into place gets the mode open() would have given it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+# fields of media details kept in the store, so details are only ever fetched once
+DETAILS_FIELDS = ('location', 'video_url')
+
+# timeline pages fetched ahead of conversion, and store writes queued ahead of the writer thread
+PAGE_PREFETCH = 2
+WRITE_QUEUE = 16
+
+
+def import_requests():
+    global requests
+    if requests is None:
+        import requests
 
 
 class PartialContentException(Exception):
     pass
 
-# all optional None, make custom typing dict
+
+class FileLock:
+    """An flock() on path, held across processes on this host. Does nothing where fcntl is missing.
+
+    Shared holders only exclude an exclusive one. Each instance has its own lock, so two instances conflict
+    even in one process.
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self.fd: Optional[int] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if fcntl is None:
+            return True
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_exc):
+        self.release()
+
+
+def open_sqlite(filename: str, shared: bool = False) -> sqlite3.Connection:
+    """Connect in WAL mode, so one connection can commit while others read.
+
+    A shared connection can be used from any thread, its owner has to serialize every use with a lock.
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    conn = sqlite3.connect(filename, check_same_thread=not shared, timeout=SQLITE_TIMEOUT)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def atomic_write(filename: str, content: Union[str, bytes]):
+    """Write to a temp file beside filename and rename it into place, so readers never see part of a file."""
+    dirname = os.path.dirname(filename) or '.'
+    os.makedirs(dirname, exist_ok=True)
+
+    fd, tmp_file = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+        os.chmod(tmp_file, FILE_MODE)
+        os.replace(tmp_file, filename)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(METRIC_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[tuple]:
+        """(upper bound, observations at or under it) per bucket, ending with +Inf."""
+        total = 0
+        buckets = []
+        for bound, count in zip(METRIC_BUCKETS + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms for a run, labelled by keyword arguments.
+
+    Exported as a JSON report or in the Prometheus textfile format, with names under METRICS_PREFIX.
+    """
+
+    def __init__(self, profiler: 'Profiler' = None):
+        self.counters: Dict[tuple, float] = {}
+        self.gauges: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, Histogram] = {}
+        self.profiler = profiler
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def profile_user(self, user: str):
+        return self.profiler.user(user) if self.profiler else nullcontext()
+
+    @contextmanager
+    def timer(self, stage: str, user: str = None):
+        """Time a stage, profiling it too when there is a profiler. user only labels the profile."""
+        start = time.perf_counter()
+        with self.profiler.stage(stage, user) if self.profiler else nullcontext():
+            try:
+                yield
+            finally:
+                self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def report(self) -> dict:
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            gauges = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.gauges.items())
+            ]
+            histograms = [
+                {
+                    'name': name, 'labels': dict(labels), 'count': hist.count, 'sum': hist.sum,
+                    'buckets': {str(bound): count for bound, count in hist.cumulative()}
+                }
+                for (name, labels), hist in sorted(self.histograms.items())
+            ]
+
+        return {
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            'elapsed': time.time() - self.started,
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms
+        }
+
+    @staticmethod
+    def _labels(labels, **extra) -> str:
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ''
+
+        def escape(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+
+    def to_prometheus(self) -> str:
+        lines = []
+        typed = set()
+
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = METRICS_PREFIX + name
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f'# TYPE {metric} counter')
+                lines.append(f'{metric}{self._labels(labels)} {value:g}')
+
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = METRICS_PREFIX + name
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f'# TYPE {metric} gauge')
+                lines.append(f'{metric}{self._labels(labels)} {value:g}')
+
+            for (name, labels), hist in sorted(self.histograms.items()):
+                metric = METRICS_PREFIX + name
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f'# TYPE {metric} histogram')
+                for bound, count in hist.cumulative():
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{metric}_bucket{self._labels(labels, le=le)} {count}')
+                lines.append(f'{metric}_sum{self._labels(labels)} {hist.sum:g}')
+                lines.append(f'{metric}_count{self._labels(labels)} {hist.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_file: str = None, prom_file: str = None):
+        if report_file:
+            atomic_write(report_file, json.dumps(self.report(), indent=2))
+            lo.i(f'Wrote run report: {report_file}')
+        if prom_file:
+            atomic_write(prom_file, self.to_prometheus())
+            lo.i(f'Wrote metrics: {prom_file}')
+
+
+class StageProfile:
+    __slots__ = ('profile', 'calls', 'wall', 'cpu', 'allocated', 'peak', 'overlapped')
+
+    def __init__(self):
+        # thread CPU time, so waiting on the network or on pacing stays out of the profile
+        self.profile = cProfile.Profile(time.thread_time)
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.allocated = 0
+        self.peak = 0
+        self.overlapped = False
+
+
+class Profiler:
+    """cProfile and tracemalloc per stage and user for --profile.
+
+    Profiles count CPU time of the thread running the stage. The rest of its wall time is reported as wait,
+    which is mostly network, pacing and waiting on worker threads.
+
+    Stage memory comes from tracemalloc's counters, as bytes still allocated at its end and the peak above its start.
+    Whole-heap snapshots are too slow to take around every stage, so top allocation sites come from one snapshot diff
+    per user, and the time they take is reported as overhead. Tracing itself still slows every allocation.
+    Stages that ran alongside another one (the thumbnail prefetch runs during pages) count each other's allocations
+    and share the peak, they are marked in the table.
+    """
+
+    def __init__(self, dirname: str):
+        self.dirname = dirname
+        self.stages: Dict[tuple, StageProfile] = {}
+        self.users: Dict[str, list] = {}
+        self.overhead = 0.0
+        self.active: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(dirname, exist_ok=True)
+        tracemalloc.start(PROFILE_FRAMES)
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        start = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')
+        ))
+        self.overhead += time.perf_counter() - start
+        return snapshot
+
+    @contextmanager
+    def user(self, user: str):
+        """Diff the heap over everything done for user, for its top allocation sites."""
+        before = self._snapshot()
+        try:
+            yield
+        finally:
+            after = self._snapshot()
+            start = time.perf_counter()
+            self.users[user] = after.compare_to(before, 'lineno')[:PROFILE_TOP]
+            self.overhead += time.perf_counter() - start
+
+    @contextmanager
+    def stage(self, name: str, user: str = None):
+        if name not in PROFILE_STAGES:
+            yield
+            return
+
+        key = (user or '_all', name)
+        with self._lock:
+            st = self.stages.get(key)
+            if st is None:
+                st = self.stages[key] = StageProfile()
+
+            if self.active:
+                st.overlapped = True
+                for other in self.active:
+                    self.stages[other].overlapped = True
+            else:
+                tracemalloc.reset_peak()
+            self.active[key] = self.active.get(key, 0) + 1
+            mem_start = tracemalloc.get_traced_memory()[0]
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+
+        try:
+            st.profile.enable()
+            profiling = True
+        except ValueError:  # since 3.12 only one profiler can be active, another thread's stage has it
+            profiling = False
+
+        try:
+            yield
+        finally:
+            if profiling:
+                st.profile.disable()
+
+            cpu = time.thread_time() - cpu
+            wall = time.perf_counter() - wall
+            current, peak = tracemalloc.get_traced_memory()
+
+            with self._lock:
+                st.calls += 1
+                st.wall += wall
+                st.cpu += cpu
+                st.allocated += current - mem_start
+                st.peak = max(st.peak, peak - mem_start)
+
+                self.active[key] -= 1
+                if not self.active[key]:
+                    del self.active[key]
+
+    def write(self):
+        """Write <user>.<stage>.pstats files and summary.txt, and log the stage table."""
+        tracemalloc.stop()
+
+        mb = 1024 * 1024
+        table = [
+            f'{"User":<20}  {"Stage":<13}  {"Calls":>5}  {"Wall":>8}  {"CPU":>8}  {"Wait":>8}  {"Alloc MB":>8}  {"Peak MB":>8}'
+        ]
+        sections = []
+
+        for (user, name), st in sorted(self.stages.items()):
+            st.profile.dump_stats(os.path.join(self.dirname, f'{user}.{name}.pstats'))
+
+            stage = name + ('*' if st.overlapped else '')
+            table.append(
+                f'{user:<20}  {stage:<13}  {st.calls:>5}  {st.wall:>7.2f}s  {st.cpu:>7.2f}s  {st.wall - st.cpu:>7.2f}s  '
+                f'{st.allocated / mb:>8.1f}  {st.peak / mb:>8.1f}'
+            )
+
+            out = io.StringIO()
+            try:
+                pstats.Stats(st.profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            except TypeError:  # nothing was profiled
+                out.write('No profile data\n')
+
+            sections.append(f'== {user} {name}\n\n{out.getvalue()}')
+
+        for user, diffs in sorted(self.users.items()):
+            allocs = '\n'.join(
+                f'{diff.size_diff / 1024:>10,.1f} KiB {diff.count_diff:>+9,}  {diff.traceback[0]}' for diff in diffs
+            )
+            sections.append(f'== {user} top allocations\n\n{allocs}\n')
+
+        notes = [f'Profiler snapshots took {self.overhead:.2f}s, outside the stage times']
+        if any(st.overlapped for st in self.stages.values()):
+            notes.append('* ran alongside another stage, memory figures include its allocations')
+
+        summary = os.path.join(self.dirname, 'summary.txt')
+        atomic_write(summary, '\n'.join(table + notes) + '\n\n' + '\n'.join(sections))
+
+        for line in table + notes:
+            lo.i(line)
+        lo.i(f'Wrote profiles: {summary}')
+
+
+class TokenBucket:
+    """Thread-safe token bucket with AIMD rate control.
+
+    The rate grows by RATE_INCREASE of the starting rate per success up to max_rate and is cut by RATE_BACKOFF on a throttle,
+    which can also pause the bucket for a Retry-After period.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1, min_rate: float = None, max_rate: float = None):
+        self.rate = rate
+        self.increase = rate * RATE_INCREASE
+        self.min_rate = min_rate if min_rate is not None else rate * RATE_FLOOR
+        self.max_rate = max_rate if max_rate is not None else rate * RATE_CEILING
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, _url: str = None) -> float:
+        """Block until a token is free, returning the seconds slept."""
+        with self._lock:
+            now = time.monotonic()
+            # updated is in the future while paused, which drains the bucket until then
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # going negative reserves the next token, so waiters are served in order
+            self.tokens -= 1
+            secs = -self.tokens / self.rate
+
+        if secs > 0:
+            time.sleep(secs)
+            return secs
+
+        return 0.0
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttle(self, pause: float = None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * RATE_BACKOFF)
+            if pause:
+                self.tokens = min(self.tokens, 0)
+                self.updated = max(self.updated, time.monotonic() + pause)
+
+
+class RateLimiter:
+    """Adaptive budgets per endpoint class: profile, graphql, details and one per image CDN host."""
+
+    def __init__(self, rates: Dict[str, float] = None):
+        self.rates = rates or ENDPOINT_RATES
+        self.buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def classify(url: str) -> str:
+        parts = urlsplit(url)
+        if parts.netloc != BASE_HOST:
+            return 'image:' + parts.netloc
+
+        if parts.path.startswith('/graphql/'):
+            return 'graphql'
+        elif parts.path.startswith('/p/'):
+            return 'details'
+        else:
+            return 'profile'
+
+    def bucket(self, url: str) -> TokenBucket:
+        key = self.classify(url)
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                rate = self.rates[key.partition(':')[0]]
+                bucket = self.buckets[key] = TokenBucket(rate, capacity=ENDPOINT_BURST)
+
+        return bucket
+
+    def wait(self, url: str) -> float:
+        return self.bucket(url).wait()
+
+    def success(self, url: str):
+        self.bucket(url).success()
+
+    def throttle(self, url: str, pause: float = None) -> float:
+        bucket = self.bucket(url)
+        bucket.throttle(pause)
+        return bucket.rate
+
+    def current_rates(self) -> Dict[str, float]:
+        """Current requests/sec of every bucket used so far."""
+        with self._lock:
+            return {key: bucket.rate for key, bucket in self.buckets.items()}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_ahead(items, size: int):
+    """Run an iterator on its own thread, keeping up to size items ready for the consumer.
+
+    Errors are raised in the consumer. Leaving the loop early stops the producer after its current item.
+    """
+    done = object()
+    buf: queue.Queue = queue.Queue(maxsize=max(1, size))
+    stop = threading.Event()
+    error: List[BaseException] = []
+
+    def produce():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        buf.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            error.append(e)
+        finally:
+            while not stop.is_set():
+                try:
+                    buf.put(done, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    thread = threading.Thread(target=produce, name='iter-ahead', daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = buf.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+    if error:
+        raise error[0]
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    status: int
+    headers: dict
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+class ResponseCache:
+    """Persistent cache of GET responses, kept beside the media cache.
+
+    Entries are served without a request for the TTL of their url class, then revalidated with
+    If-None-Match/If-Modified-Since. The least recently used are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, filename: str = None, ttls: Dict[str, float] = None, max_bytes: int = HTTP_CACHE_MAX_BYTES):
+        self.filename = filename or PICKLE_DIR + HTTP_CACHE_NAME
+        self.ttls = ttls if ttls is not None else HTTP_CACHE_TTLS
+        self.max_bytes = max_bytes
+
+        self.total_bytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+        self.conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = open_sqlite(self.filename, shared=True)
+            with self.conn:
+                self.conn.execute(
+                    'CREATE TABLE IF NOT EXISTS responses ('
+                    'url TEXT PRIMARY KEY, status INTEGER, headers BLOB, body BLOB, etag TEXT, last_modified TEXT, '
+                    'fetched_at REAL, accessed_at REAL, size INTEGER)'
+                )
+                self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)')
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        return self.conn
+
+    @staticmethod
+    def url_class(url: str) -> Optional[str]:
+        parts = urlsplit(url)
+        # the home page and login set the session cookies, never serve them from cache
+        if parts.netloc != BASE_HOST or parts.path == '/' or parts.path.startswith('/accounts/'):
+            return None
+        return RateLimiter.classify(url)
+
+    def ttl(self, url: str) -> Optional[float]:
+        return self.ttls.get(self.url_class(url))
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        if self.ttl(url) is None:
+            return None
+
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT url, status, headers, body, etag, last_modified, fetched_at FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            with conn:
+                conn.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+
+        entry = CacheEntry(*row)
+        return entry._replace(headers=pickle.loads(entry.headers))
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        fresh = time.time() - entry.fetched_at < self.ttl(entry.url)
+        if fresh:
+            self.hits += 1
+        return fresh
+
+    @staticmethod
+    def conditional_headers(entry: CacheEntry) -> Dict[str, str]:
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def revalidate(self, entry: CacheEntry) -> CacheEntry:
+        """Mark an entry fresh again after a 304."""
+        self.revalidated += 1
+        now = time.time()
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute('UPDATE responses SET fetched_at = ? WHERE url = ?', (now, entry.url))
+        return entry._replace(fetched_at=now)
+
+    def put(self, url: str, response: requests.Response, body: bytes = None):
+        """Store a response, or just body with its headers when only part of a streamed response was read."""
+        if self.ttl(url) is None or response.status_code != 200:
+            return
+
+        if body is None:
+            body = response.content
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+        now = time.time()
+
+        with self._lock:
+            conn = self._connect()
+            old = conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, response.status_code, pickle.dumps(headers), body,
+                     response.headers.get('ETag'), response.headers.get('Last-Modified'), now, now, len(body))
+                )
+            self.total_bytes += len(body) - (old[0] if old else 0)
+
+            if self.total_bytes > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        # other processes add to the same file
+        self.total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        evict = []
+        for url, size in conn.execute('SELECT url, size FROM responses ORDER BY accessed_at'):
+            if self.total_bytes <= self.max_bytes:
+                break
+            evict.append((url,))
+            self.total_bytes -= size
+
+        with conn:
+            conn.executemany('DELETE FROM responses WHERE url = ?', evict)
+
+    @staticmethod
+    def to_response(entry: CacheEntry) -> requests.Response:
+        resp = requests.Response()
+        resp.url = entry.url
+        resp.status_code = entry.status
+        resp.headers.update(entry.headers)
+        resp.headers['Content-Length'] = str(len(entry.body))
+        resp.raw = io.BytesIO(entry.body)
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        resp.from_cache = True
+        return resp
+
+
+def make_transport(pool_size: int, http2: bool = False) -> BaseAdapter:
+    from insta_http import Http2Adapter, PooledAdapter, httpx
+
+    if http2:
+        if httpx is not None:
+            return Http2Adapter(pool_size)
+        lo.w('httpx is not installed, using HTTP/1.1')
+
+    return PooledAdapter(pool_size)
+
+
+def log_connection_stats(transport: BaseAdapter):
+    stats = getattr(transport, 'connection_stats', lambda: {})()
+    if not stats:
+        return
+
+    lo.i('Connections: ' + ', '.join(
+        f'{host} {made:,} requests over {opened:,} ({1 - opened / made if made else 0:.0%} reused)'
+        for host, (made, opened) in sorted(stats.items())
+    ))
+
+
 class Media:
-    def __init__(self, **info):
-        self.id: str = info['id']
-        self.shortcode: str = info['shortcode']
-        self.display_url: str = info['display_url']
-        self.thumbnail_src: str = info['thumbnail_src']
-        self.is_video: bool = info['is_video']
-        self.video_url: str = info['video_url']
-        self.video_view_count: int = info['video_view_count']
+    __slots__ = (
+        'id', 'shortcode', 'display_url', 'thumbnail_src', 'is_video', 'video_url', 'video_view_count',
+        'taken_at_timestamp', 'likes', 'captions', 'location', 'thumb_file'
+    )
+
+    def __init__(
+        self,
+        id: str = None,
+        shortcode: str = None,
+        display_url: str = None,
+        thumbnail_src: str = None,
+        is_video: bool = None,
+        video_url: str = None,
+        video_view_count: int = None,
+        taken_at_timestamp: int = None,
+        likes: int = None,
+        captions: List[str] = None,
+        location: Dict[str, Union[str, bool]] = None,
+        thumb_file: str = None
+    ):
+        self.id: Optional[str] = id
+        self.shortcode: Optional[str] = shortcode
+        self.display_url: Optional[str] = display_url
+        self.thumbnail_src: Optional[str] = thumbnail_src
+        self.is_video: Optional[bool] = is_video
+        self.video_url: Optional[str] = video_url
+        self.video_view_count: Optional[int] = video_view_count
         #self.accessibility_caption: str = info['accessibility_caption']
         #self.comments_disabled: bool = info['comments_disabled']
-        self.taken_at_timestamp: int = info['taken_at_timestamp']
-        self.likes: int = info['likes']
+        self.taken_at_timestamp: Optional[int] = taken_at_timestamp
+        self.likes: Optional[int] = likes
         #self.comments: int = info['comments']
-        self.captions: List[str] = info['captions']
+        self.captions: List[str] = captions if captions is not None else []
         #self.dimensions: Dict[str, int] = info['dimensions']  # height, width
-        self.location: Dict[str, Union[str, bool]] = info['location']  # id: int, has_public_page: bool, name: str, slug: str, address_json: strjson
+        self.location: Optional[Dict[str, Union[str, bool]]] = location  # id: int, has_public_page: bool, name: str, slug: str, address_json: strjson
 
         #self.mimetype: str = None
-        self.thumb_file: Optional[str] = None
+        self.thumb_file: Optional[str] = thumb_file
         #self.content = None  # todo do i need this? and make these all thumb_
 
     def __str__(self):
@@ -183,21 +1069,573 @@ class Media:
         return self.__str__()
 
 
-class InstaGet:
-    def __init__(self, cookiejar=None):
-        self.cookiejar = cookiejar
+def likes_per_day(likes: Optional[int], timestamp: Optional[int], now: float) -> float:
+    # posts younger than a day count as a full day so new ones don't dominate
+    age_days = max((now - (timestamp or now)) / DAY_SECS, 1)
+    return (likes or 0) / age_days
+
+
+def rank_media(media: List[Media], n: Optional[int], rank: str = 'likes') -> List[Media]:
+    """Top n media by rank in a single pass, or all of them sorted if n is None."""
+    if rank == 'likes':
+        key = lambda m: m.likes or 0
+    elif rank == 'views':
+        key = lambda m: m.video_view_count or 0
+    elif rank == 'recent':
+        key = lambda m: m.taken_at_timestamp or 0
+    elif rank == 'likes_per_day':
+        now = time.time()
+        key = lambda m: likes_per_day(m.likes, m.taken_at_timestamp, now)
+    else:
+        raise ValueError(f'Unknown rank: {rank}')
+
+    if n is None:
+        return sorted(media, key=key, reverse=True)
+    return heapq.nlargest(n, media, key=key)
+
+
+class MediaKeys:
+    """Sort keys of every cached node, held in compact arrays instead of Media objects."""
+
+    __slots__ = ('shortcodes', 'likes', 'timestamps', 'is_video', 'video_views')
+
+    def __init__(self):
+        self.shortcodes: List[str] = []
+        self.likes = array('q')
+        self.timestamps = array('q')
+        self.is_video = array('b')
+        self.video_views = array('q')
+
+    def __len__(self):
+        return len(self.shortcodes)
+
+    def rank_key(self, rank: str, now: float = None):
+        if rank == 'likes':
+            return self.likes.__getitem__
+        elif rank == 'views':
+            return self.video_views.__getitem__
+        elif rank == 'recent':
+            return self.timestamps.__getitem__
+        elif rank == 'likes_per_day':
+            now = now or time.time()
+            likes, timestamps = self.likes, self.timestamps
+            return lambda i: likes_per_day(likes[i], timestamps[i], now)
+        raise ValueError(f'Unknown rank: {rank}')
+
+    def top(self, n: int, rank: str = 'likes') -> List[str]:
+        idxs = heapq.nlargest(n, range(len(self.shortcodes)), key=self.rank_key(rank))
+        return [self.shortcodes[i] for i in idxs]
+
+
+class MediaStore:
+    """Single-file SQLite cache for a user's profile, raw media nodes and pagination state.
+
+    Sort keys are kept in their own columns so they can be read without unpickling the nodes.
+    """
+
+    def __init__(self, user: str):
+        self.user = user
+        self.path = PICKLE_DIR + user + STORE_EXT
+
+        # the store writer has its own connection
+        self.conn = open_sqlite(self.path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS media ('
+                'shortcode TEXT PRIMARY KEY, id TEXT, taken_at_timestamp INTEGER, likes INTEGER, '
+                'is_video INTEGER, video_view_count INTEGER, node BLOB)'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS details (shortcode TEXT PRIMARY KEY, data BLOB)')
+
+    @classmethod
+    def open(cls, user: str) -> 'MediaStore':
+        store = cls(user)
+
+        legacy_dir = PICKLE_DIR + user
+        if os.path.isdir(legacy_dir) and not store.get_meta('migrated'):
+            with FileLock(store.path + LOCK_EXT):
+                # another process may have imported them while we waited
+                if not store.get_meta('migrated'):
+                    lo.i(f'Importing pickles from {legacy_dir}/...')
+                    imported = store.import_pickle_dir(legacy_dir)
+                    lo.i(f'Imported {imported:,} items into {store.path}, {legacy_dir}/ can be removed')
+
+        return store
+
+    def close(self):
+        self.conn.close()
+
+    def get_meta(self, key: str):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def set_meta(self, key: str, value):
+        self.put_meta(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def put_meta(self, key: str, data: bytes):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, data))
+
+    @staticmethod
+    def _node_row(node: dict) -> tuple:
+        return (
+            node['shortcode'],
+            node.get('id'),
+            node.get('taken_at_timestamp'),
+            node.get('edge_media_preview_like', {}).get('count'),
+            node.get('is_video'),
+            node.get('video_view_count'),
+            pickle.dumps(node, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+
+    def put_nodes(self, nodes: List[dict]):
+        """Write a batch of raw nodes in a single transaction."""
+        self.put_rows([self._node_row(node) for node in nodes])
+
+    def put_rows(self, rows: List[tuple]):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO media '
+                '(shortcode, id, taken_at_timestamp, likes, is_video, video_view_count, node) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def _get_pickled(self, table: str, column: str, shortcodes: List[str]) -> Dict[str, dict]:
+        """Unpickled column of the rows of table with these shortcodes, in batches of SQL_BATCH."""
+        values = {}
+        for i in range(0, len(shortcodes), SQL_BATCH):
+            batch = shortcodes[i:i + SQL_BATCH]
+            query = f'SELECT shortcode, {column} FROM {table} WHERE shortcode IN ({",".join("?" * len(batch))})'
+            for shortcode, data in self.conn.execute(query, batch):
+                values[shortcode] = pickle.loads(data)
+
+        return values
+
+    def get_nodes(self, shortcodes: List[str]) -> Dict[str, dict]:
+        return self._get_pickled('media', 'node', shortcodes)
+
+    def get_details(self, shortcodes: List[str]) -> Dict[str, dict]:
+        return self._get_pickled('details', 'data', shortcodes)
+
+    def put_detail_rows(self, rows: List[tuple]):
+        """Write (shortcode, pickled details) rows in a single transaction."""
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO details (shortcode, data) VALUES (?, ?)', rows)
+
+    def load_keys(self) -> MediaKeys:
+        keys = MediaKeys()
+        query = 'SELECT shortcode, likes, taken_at_timestamp, is_video, video_view_count FROM media'
+        for shortcode, likes, timestamp, is_video, video_views in self.conn.execute(query):
+            keys.shortcodes.append(shortcode)
+            keys.likes.append(likes or 0)
+            keys.timestamps.append(timestamp or 0)
+            keys.is_video.append(bool(is_video))
+            keys.video_views.append(video_views or 0)
+
+        return keys
+
+    def shortcodes(self) -> set:
+        return {sc for (sc,) in self.conn.execute('SELECT shortcode FROM media')}
+
+    def import_pickle_dir(self, dirname: str) -> int:
+        """Import a legacy pkls/<user>/ directory of profile, state and m_<shortcode> pickles."""
+        for key in ('profile', 'state'):
+            filepath = f'{dirname}/{key}.pkl'
+            if os.path.exists(filepath):
+                with open(filepath, 'rb') as f:
+                    self.set_meta(key, pickle.load(f))
+
+        nodes = []
+        for filepath in glob(f'{dirname}/m_*.pkl'):
+            try:
+                with open(filepath, 'rb') as f:
+                    nodes.append(pickle.load(f))
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                lo.w(f'Skipping unreadable pickle {filepath}: {repr(e)}')
+
+        self.put_nodes([node for node in nodes if node.get('shortcode')])
+        self.set_meta('migrated', True)
+
+        return len(nodes)
+
+
+class StoreWriter:
+    """Applies store writes on a thread with its own connection, so paging never waits on a commit.
+
+    Nodes and values are pickled by the caller, later changes to them are not seen by the writer.
+    Reads through the store see a write once flush() has returned.
+    """
+
+    _STOP = object()
+
+    def __init__(self, user: str, queue_size: int = WRITE_QUEUE):
+        self.user = user
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.error: Optional[BaseException] = None
+        self.written = 0
+
+        self.thread = threading.Thread(target=self._run, name=f'store-{user}', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        store = MediaStore(self.user)
+        try:
+            while True:
+                op = self.queue.get()
+                try:
+                    if op is self._STOP:
+                        return
+                    if self.error is None:
+                        self._apply(store, *op)
+                except Exception as e:  # reported by the next flush
+                    self.error = e
+                finally:
+                    self.queue.task_done()
+        finally:
+            store.close()
+
+    def _apply(self, store: MediaStore, kind: str, data):
+        if kind == 'rows':
+            store.put_rows(data)
+            self.written += len(data)
+        elif kind == 'details':
+            store.put_detail_rows(data)
+        elif kind == 'meta':
+            store.put_meta(*data)
+
+    @staticmethod
+    def _dumps(value) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def put_nodes(self, nodes: List[dict]):
+        if nodes:
+            self.queue.put(('rows', [MediaStore._node_row(node) for node in nodes]))
+
+    def put_details(self, details: Dict[str, dict]):
+        if details:
+            self.queue.put(('details', [(sc, self._dumps(data)) for sc, data in details.items()]))
+
+    def set_meta(self, key: str, value):
+        self.queue.put(('meta', (key, self._dumps(value))))
+
+    def flush(self):
+        """Wait until every queued write is committed."""
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.queue.put(self._STOP)
+            self.thread.join()
+
+
+class ThumbEntry(NamedTuple):
+    path: str
+    ext: str
+    size: int
+    mtime: float
+    digest: str
+
+
+class ThumbIndex:
+    """Content-addressed thumbnails.
+
+    Blobs are named by the sha256 of their bytes in THUMB_DIR, so an image saved under several shortcodes is
+    stored once. The shortcode to digest table lives beside the cache, and blobs are found with one scan per run.
+
+    Processes adding thumbnails hold the shared lock from locked(), gc and the legacy import need it exclusively.
+    """
+
+    def __init__(self, dirname: str = None, index_file: str = None):
+        self.dirname = dirname or THUMB_DIR
+        self.index_file = index_file or PICKLE_DIR + THUMB_INDEX_NAME
+
+        self.blobs: Dict[str, ThumbEntry] = {}
+        self.shortcodes: Dict[str, str] = {}
+        self.unsaved: Dict[str, str] = {}
+        self.deduped = 0
+
+        self.conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.conn is not None:
+            return
+
+        self.conn = open_sqlite(self.index_file, shared=True)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS thumbs (shortcode TEXT PRIMARY KEY, digest TEXT)')
+
+    def locked(self, shared: bool = True) -> FileLock:
+        return FileLock(self.index_file + LOCK_EXT, shared=shared)
+
+    def load(self):
+        self._connect()
+        with self._lock:
+            self.shortcodes = dict(self.conn.execute('SELECT shortcode, digest FROM thumbs'))
+            self.shortcodes.update(self.unsaved)
+
+        legacy = self.scan()
+        if legacy:
+            with self.locked(shared=False):
+                legacy = self.scan()
+                if legacy:
+                    self.import_legacy(legacy)
+
+    def scan(self) -> List[tuple]:
+        """Find every blob with one scandir. Returns (shortcode, path) of files saved before content addressing."""
+        blobs: Dict[str, ThumbEntry] = {}
+        legacy = []
+
+        with os.scandir(self.dirname) as it:
+            for entry in it:
+                # skips temp files from _stream_to_temp and .empty
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+
+                stem, ext = os.path.splitext(entry.name)
+                if RE_DIGEST.match(stem):
+                    stat = entry.stat()
+                    blobs[stem] = ThumbEntry(entry.path, ext, stat.st_size, stat.st_mtime, stem)
+                else:
+                    legacy.append((stem, entry.path))
+
+        with self._lock:
+            self.blobs = blobs
+
+        return legacy
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def import_legacy(self, legacy: List[tuple]):
+        lo.i(f'Moving {len(legacy):,} thumbnails to content-addressed storage...')
+
+        for shortcode, path in legacy:
+            size = os.path.getsize(path)
+            if size < THUMB_MIN_BYTES:
+                os.remove(path)
+                continue
+
+            self.add(shortcode, path, self.hash_file(path), os.path.splitext(path)[1], size)
+
+        self.save()
+
+    def _put_blob(self, tmp_file: str, digest: str, ext: str, size: int) -> ThumbEntry:
+        existing = self.blobs.get(digest)
+        if existing is not None and existing.size == size and os.path.exists(existing.path):
+            os.remove(tmp_file)
+            self.deduped += 1
+            return existing
+
+        # a blob of the wrong size is damaged, the verified temp file replaces it
+        path = self.dirname + digest + ext
+        os.chmod(tmp_file, FILE_MODE)
+        os.replace(tmp_file, path)
+        entry = self.blobs[digest] = ThumbEntry(path, ext, size, time.time(), digest)
+
+        return entry
+
+    def add(self, shortcode: str, tmp_file: str, digest: str, ext: str, size: int) -> ThumbEntry:
+        """Move a verified file into the store as the thumbnail for shortcode."""
+        with self._lock:
+            entry = self._put_blob(tmp_file, digest, ext, size)
+            self.shortcodes[shortcode] = digest
+            self.unsaved[shortcode] = digest
+
+        return entry
+
+    def save(self):
+        self._connect()
+        with self._lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO thumbs (shortcode, digest) VALUES (?, ?)', self.unsaved.items())
+            self.unsaved = {}
+
+    def get(self, shortcode: str) -> Optional[ThumbEntry]:
+        """The saved thumbnail for shortcode, or None if there is none or it is empty."""
+        digest = self.shortcodes.get(shortcode)
+        entry = self.blobs.get(digest) if digest else None
+        if entry is None or entry.size < THUMB_MIN_BYTES:
+            return None
+        return entry
+
+    def missing(self, media_list: List[Media]) -> List[Media]:
+        """Point media at their saved thumbnails and return the ones without one."""
+        to_save: List[Media] = []
+        for m in media_list:
+            saved = self.get(m.shortcode)
+            if not saved:
+                to_save.append(m)
+            else:
+                m.thumb_file = saved.path
+
+        return to_save
+
+    def gc(self, referenced: set) -> tuple:
+        """Forget shortcodes not in referenced, then delete blobs no shortcode uses.
 
+        Needs the exclusive lock, the index and blobs are reread first to see what other processes added.
+        Returns the number of shortcodes and blobs removed and the bytes freed.
+        """
+        self.save()
+        self.load()
+
+        with self._lock:
+            stale = [sc for sc in self.shortcodes if sc not in referenced]
+            with self.conn:
+                self.conn.executemany('DELETE FROM thumbs WHERE shortcode = ?', ((sc,) for sc in stale))
+            for sc in stale:
+                del self.shortcodes[sc]
+
+            used = set(self.shortcodes.values())
+            blobs = [entry for digest, entry in self.blobs.items() if digest not in used]
+            freed = 0
+            for entry in blobs:
+                if os.path.exists(entry.path):
+                    os.remove(entry.path)
+                del self.blobs[entry.digest]
+                freed += entry.size
+
+        return len(stale), len(blobs), freed
+
+
+class DetailsEnricher:
+    """Fills in a missing location or video_url from media details on a bounded worker pool.
+
+    Fetches run while pagination continues. Results are applied, cached and saved from the thread calling collect().
+    """
+
+    def __init__(self, scraper: 'InstaGet', workers: int = DETAILS_WORKERS, queue_size: int = DETAILS_QUEUE):
+        self.scraper = scraper
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.pending: List[tuple] = []
+
+        self.fetched = 0
+        self.cached = 0
+        self.failed = 0
+
+    def reset(self):
+        self.fetched = self.cached = self.failed = 0
+
+    def _apply(self, node: dict, media: Media, details: dict):
+        if self.scraper.get_location and node.get('location') is None:
+            node['location'] = media.location = details.get('location')
+        if node.get('is_video') is True and node.get('video_url') is None:
+            node['video_url'] = media.video_url = details.get('video_url')
+
+    def _fetch(self, shortcode: str) -> Optional[dict]:
+        try:
+            resp = self.scraper._get_media_details(shortcode)
+        finally:
+            self.slots.release()
+
+        if not resp:
+            return None
+
+        data = resp.get('graphql', {}).get('shortcode_media')
+        if not data:
+            return None
+
+        return {k: data.get(k) for k in DETAILS_FIELDS}
+
+    def enrich(self, items: List[tuple]):
+        """Apply cached details to (node, media) pairs now and queue fetches for the rest.
+
+        Blocks when queue_size fetches are already waiting, so paging can't run far ahead.
+        """
+        if not items:
+            return
+
+        cached = self.scraper.get_store().get_details([node['shortcode'] for node, _ in items])
+
+        for node, media in items:
+            details = cached.get(node['shortcode'])
+            if details is not None:
+                self.cached += 1
+                self.scraper.metrics.inc('details_total', result='cached')
+                self._apply(node, media, details)
+            else:
+                self.slots.acquire()
+                self.pending.append((self.pool.submit(self._fetch, node['shortcode']), node, media))
+
+    def collect(self, wait: bool = False):
+        """Apply and save finished fetches, or all of them if wait is set."""
+        # one done() check per fetch, one finishing between two checks would be in neither list
+        done = []
+        still = []
+        for item in self.pending:
+            (done if wait or item[0].done() else still).append(item)
+        self.pending = still
+        if not done:
+            return
+
+        nodes: List[dict] = []
+        details_all: Dict[str, dict] = {}
+
+        for future, node, media in done:
+            try:
+                details = future.result()
+            except (ValueError, requests.exceptions.RequestException) as e:
+                lo.w(f'Media details failed for {node["shortcode"]}: {repr(e)}')
+                details = None
+
+            if details is None:
+                self.failed += 1
+                self.scraper.metrics.inc('details_total', result='failed')
+                continue
+
+            self.fetched += 1
+            self.scraper.metrics.inc('details_total', result='fetched')
+            self._apply(node, media, details)
+            details_all[node['shortcode']] = details
+            nodes.append(node)
+
+        writer = self.scraper.get_writer()
+        writer.put_details(details_all)
+        writer.put_nodes(nodes)
+
+
+class SessionManager:
+    """The requests session shared by every scraper, saved with its cookies, headers and login between runs.
+
+    A saved session is used without any request for as long as its cookies are valid, and is only replaced when
+    a request fails with an auth error. One worker (and one process) authenticates at a time, the others wait and
+    use its session.
+    """
+
+    def __init__(self, filename: str = None, transport: BaseAdapter = None):
+        import_requests()
+
+        self.filename = filename
         self.session = requests.Session()
+        if transport is not None:
+            self.session.mount('https://', transport)
+            self.session.mount('http://', transport)
         self.session.headers = {'user-agent': USER_AGENT}
-        if self.cookiejar and os.path.exists(self.cookiejar):
-            with open(self.cookiejar, 'rb') as f:
-                self.session.cookies.update(pickle.load(f))
         self.session.cookies.set('ig_pr', '1')
 
-        self.cookies = None
-        self.rhx_gis = ''
         self.is_authed = False
         self.logged_in = False
+        # bumped whenever the session is replaced, so workers that failed on the same one authenticate once
+        self.generation = 0
+        self.auths = 0
+        # of the saved session, to notice one saved by another process
+        self.mtime: Optional[int] = None
 
         if CREDENTIALS_FILE.is_file():
             login_info = CREDENTIALS_FILE.read_text().splitlines()
@@ -207,117 +1645,466 @@ class InstaGet:
             self.login_user = None
             self.login_pass = None
 
-        self.last_request = None
+        self._lock = threading.RLock()
+
+    def _set_headers(self, headers: dict):
+        # workers read the headers while they send, so they are replaced rather than changed under them
+        self.session.headers = {**self.session.headers, **headers}
+
+    def _cookie(self, name: str) -> Optional[str]:
+        for cookie in self.session.cookies:
+            if cookie.name == name and not cookie.is_expired():
+                return cookie.value
+
+        return None
+
+    def is_valid(self) -> bool:
+        """Whether the session looks usable, from its cookies and headers alone."""
+        if not self.session.headers.get('X-CSRFToken'):
+            return False
+
+        if self.login_user and self.login_pass:
+            return self.logged_in and self._cookie('sessionid') is not None
+
+        return True
+
+    def load(self) -> bool:
+        """Use the saved session, or the cookies saved by older versions. Returns whether it is valid."""
+        if not self.filename:
+            return False
+
+        legacy = not os.path.exists(self.filename)
+        filename = COOKIE_NAME if legacy else self.filename
+        if not os.path.exists(filename):
+            return False
+
+        with FileLock(filename + LOCK_EXT, shared=True), open(filename, 'rb') as f:
+            state = pickle.load(f)
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+
+        if legacy:
+            state = {'cookies': state}
+        else:
+            self.mtime = mtime
+
+        self.session.cookies.update(state['cookies'])
+        headers = state.get('headers') or {}
+        csrf_token = self._cookie('csrftoken')
+        if csrf_token and 'X-CSRFToken' not in headers:
+            headers = {**headers, 'Referer': BASE_URL, 'X-CSRFToken': csrf_token}
+        self._set_headers(headers)
+
+        self.logged_in = state.get('logged_in', self._cookie('sessionid') is not None)
+        self.is_authed = self.is_valid()
+
+        if self.is_authed:
+            lo.i(f'Using the saved {"login" if self.logged_in else "session"} from {filename}')
+
+        return self.is_authed
+
+    def save(self):
+        if not self.filename:
+            return
+
+        state = {'cookies': self.session.cookies, 'headers': dict(self.session.headers), 'logged_in': self.logged_in}
+
+        with self._lock, FileLock(self.filename + LOCK_EXT):
+            atomic_write(self.filename, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+            self.mtime = os.stat(self.filename).st_mtime_ns
+
+    def _reload(self) -> bool:
+        """Use a session another process saved since this one was loaded."""
+        if not self.filename or not os.path.exists(self.filename) or os.stat(self.filename).st_mtime_ns == self.mtime:
+            return False
+
+        if not self.load():
+            return False
+
+        self.generation += 1
+        return True
+
+    def ensure(self, get) -> bool:
+        """Authenticate unless the session is already usable. get fetches a URL without authenticating on failure."""
+        if self.is_authed:
+            return True
+
+        return self.authenticate(get, self.generation)
+
+    def authenticate(self, get, generation: int) -> bool:
+        """Replace the session generation failed on, unless another worker or process already has."""
+        with self._lock, FileLock(self.filename + '.login' + LOCK_EXT) if self.filename else nullcontext():
+            if self.generation != generation:
+                return self.is_authed
+
+            if self._reload():
+                return True
+
+            # the session is left as it is, a request failing after the cap doesn't fail the users after it
+            if self.auths >= MAX_AUTHS:
+                lo.e(f'Authenticated {self.auths} times this run, not trying again')
+                return False
+            self.auths += 1
+            self.is_authed = False
+
+            lo.i('Authing...')
+            if self.login_user and self.login_pass:
+                self._login(get)
+            else:
+                self._auth(get)
+
+            self.generation += 1
+            if self.is_authed:
+                self.save()
+
+            return self.is_authed
+
+    def _fetch_csrf_token(self, get) -> Optional[str]:
+        req = get(BASE_URL)
+        if not req:
+            return None
+
+        return req.cookies.get('csrftoken') or self._cookie('csrftoken')
+
+    def _auth(self, get):
+        self._set_headers({'Referer': BASE_URL, 'user-agent': STORIES_UA})
+        csrf_token = self._fetch_csrf_token(get)
+
+        if csrf_token:
+            self._set_headers({'X-CSRFToken': csrf_token, 'user-agent': USER_AGENT})
+            self.is_authed = True
+        else:
+            lo.e('Could not auth.')
+
+    def _login(self, get):
+        self.logged_in = False
+        self._set_headers({'Referer': BASE_URL, 'user-agent': STORIES_UA})
+        csrf_token = self._fetch_csrf_token(get)
+
+        if csrf_token:
+            self._set_headers({'X-CSRFToken': csrf_token})
+
+            login_data = {'username': self.login_user, 'password': self.login_pass}
+            login = self.session.post(LOGIN_URL, data=login_data, allow_redirects=True)
+
+            self._set_headers({'X-CSRFToken': login.cookies.get('csrftoken', csrf_token)})
+            login_text = json.loads(login.text)
+
+            if login_text.get('authenticated') and login.status_code == 200:
+                self.logged_in = True
+                self.is_authed = True
+                self._set_headers({'user-agent': USER_AGENT})
+            else:
+                lo.e('Login failed for ' + self.login_user)
+
+                if 'checkpoint_url' in login_text:
+                    checkpoint_url = login_text.get('checkpoint_url')
+                    lo.e('Please verify your account at ' + BASE_URL[0:-1] + checkpoint_url)
+                elif 'errors' in login_text:
+                    for count, error in enumerate(login_text['errors'].get('error')):
+                        count += 1
+                        lo.d('Session error %(count)s: "%(error)s"' % locals())
+                else:
+                    lo.e(json.dumps(login_text))
+        else:
+            lo.e('Could not auth.')
+
+
+class InstaGet:
+    def __init__(
+        self, cookiejar=None, rate_limiter: RateLimiter = None, thumbs: ThumbIndex = None, http_cache: ResponseCache = None,
+        transport: BaseAdapter = None, metrics: Metrics = None, sessions: SessionManager = None
+    ):
+        import_requests()
+
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.thumbs = thumbs
+        self.http_cache = http_cache or ResponseCache()
+
+        self.metrics = metrics or Metrics()
+        self.transport = transport or make_transport(IMG_WORKERS + DETAILS_WORKERS + POOL_SLACK)
+
+        # cookiejar is where the session is saved when no shared sessions are given
+        if sessions is None:
+            sessions = SessionManager(cookiejar, transport=self.transport)
+            sessions.load()
+        self.sessions = sessions
+        self.session = sessions.session
+
+        self.rhx_gis = ''
 
         self.user: Optional[str] = None
         self.get_location = False
+        self.enricher = DetailsEnricher(self)
 
-        self.jinja_env = Environment(
-            loader=FileSystemLoader(TEMPLATE_DIR),
-            trim_blocks=True,
-            lstrip_blocks=True
-        )
+        self.store: Optional[MediaStore] = None
+        self.writer: Optional[StoreWriter] = None
+        # thumbnails of the cached top items, downloaded while the timeline is paged
+        self.thumb_stage = ThreadPoolExecutor(max_workers=1)
+        self.thumb_prefetch = None
 
-    def _sleep(self, secs: float = None):
-        if secs is None:
-            if not self.last_request:
-                secs = 0
-            else:
-                curr_time = time.time()
-                sdiff = curr_time - self.last_request
-                secs = SLEEP_DELAY - sdiff
+        # end_cursor and has_next_page of the oldest page fetched, newest_timestamp of the newest post cached, where
+        # fetching new posts stops, and new_cursors where runs fetching new posts stopped before reaching the cache
+        self.sync_state: dict = {}
+        self.pages_fetched = 0
+        # end_cursor, has_next and whether cached media was reached where the last fetch_media stopped
+        self.page_stop = (None, False, False)
 
+    @staticmethod
+    def _sleep(secs: float):
         if secs > 0:
             time.sleep(secs)
 
-    def _set_last(self):
-        self.last_request = time.time()
+    def safe_get(self, url: str, stream: bool = False, reauth: bool = True, headers: Dict[str, str] = None):
+        """GET url paced by the rate limiter, retrying errors and throttling.
+
+        headers are sent with this request only, the session is shared. An auth error from instagram replaces
+        the shared session and retries once, unless reauth is False.
+        """
+        limiter = self.rate_limiter
+        cache = self.http_cache
+        metrics = self.metrics
+        endpoint = limiter.classify(url).split(':')[0]
+        # image CDNs answer 403 for expired links, a new session would not help
+        reauth = reauth and urlsplit(url).netloc == BASE_HOST
+
+        headers = dict(headers or {})
+        cached = cache.get(url)
+        if cached is not None:
+            if cache.is_fresh(cached):
+                lo.d(f'Using cached response for {url}')
+                return cache.to_response(cached)
+            headers.update(cache.conditional_headers(cached))
 
-    def safe_get(self, url: str, stream: bool = False, secs: float = None):
         tries = 0
+        throttles = 0
         retry_delay = RETRY_DELAY
 
         while tries <= MAX_RETRIES:
-            self._sleep(secs=secs)
+            metrics.inc('sleep_seconds_total', limiter.wait(url), reason='pacing')
+            generation = self.sessions.generation
 
             try:
-                response = self.session.get(
-                    url, timeout=CONNECT_TIMEOUT, cookies=self.cookies, stream=stream
-                )
+                start = time.perf_counter()
+                try:
+                    response = self.session.get(url, timeout=CONNECT_TIMEOUT, stream=stream, headers=headers)
+                except requests.exceptions.RequestException:
+                    metrics.inc('requests_total', endpoint=endpoint, status='error')
+                    raise
+                finally:
+                    metrics.observe('request_seconds', time.perf_counter() - start, endpoint=endpoint)
 
                 status = response.status_code
-                if status in (403, 404, 429):
+                metrics.inc('requests_total', endpoint=endpoint, status=str(status))
+                if status == 304 and cached is not None:
+                    limiter.success(url)
+                    return cache.to_response(cache.revalidate(cached))
+
+                if status == 429:
+                    pause = parse_retry_after(response.headers.get('Retry-After'))
+                    if pause is None:
+                        pause = RETRY_DELAY * 2 ** throttles
+                    rate = limiter.throttle(url, pause)
+                    response.close()
+
+                    if throttles < MAX_THROTTLE_RETRIES:
+                        lo.w(f'Rate limited, pausing {pause:.0f}s at {rate:.2f} req/s: {url}')
+                        metrics.inc('retries_total', endpoint=endpoint, reason='throttled')
+                        throttles += 1
+                        continue
+
+                    lo.e(f'Rate limited, giving up: {url}')
+                    return
+
+                # a 403 is a single forbidden item, only these mean the session itself was refused
+                if reauth and (status == 401 or urlsplit(response.url).path.startswith((LOGIN_PATH, CHECKPOINT_PATH))):
+                    response.close()
+                    reauth = False
+
+                    lo.w(f'Auth error ({status}), authenticating again: {url}')
+                    metrics.inc('retries_total', endpoint=endpoint, reason='auth')
+                    if self.sessions.authenticate(self._auth_get, generation):
+                        continue
+
+                    return
+
+                if status in (403, 404):
                     if status == 403:
                         lo.w(f'Forbidden: {url}')
                     elif status == 404:
                         lo.w(f'Not found: {url}')
-                    elif status == 429:
-                        lo.w(f'Rate limited: {url}')
 
                     return
 
                 response.raise_for_status()
 
-                if not stream:
+                # content is decoded, so a compressed body can't be checked against the header
+                if not stream and 'Content-Encoding' not in response.headers:
                     content_length = response.headers.get('Content-Length')
                     if content_length is not None and len(response.content) != int(content_length):
                         raise PartialContentException('Partial response')
 
+                if not stream:
+                    metrics.inc('response_bytes_total', len(response.content), endpoint=endpoint)
+
             except (requests.exceptions.RequestException, PartialContentException) as e:
                 if tries < MAX_RETRIES:
                     lo.w('Retrying after {} seconds for exception {} on {}...'.format(retry_delay, repr(e), url))
+                    metrics.inc('retries_total', endpoint=endpoint, reason='error')
+                    metrics.inc('sleep_seconds_total', retry_delay, reason='retry')
                     self._sleep(retry_delay)
-                    self._set_last()
                     retry_delay *= 2
                     tries += 1
                     continue
                 else:
                     lo.e('Max retries hit on {}'.format(url))
-                    self._set_last()
                     return
 
             else:
-                self._set_last()
+                limiter.success(url)
+                if not stream:
+                    cache.put(url, response)
                 return response
 
-    def save_media(self, media: Media, overwrite: bool = True):
+    def authenticate(self) -> bool:
+        """Make sure the shared session is usable, only sending requests when it is not."""
+        with self.metrics.timer('auth', user=self.user):
+            return self.sessions.ensure(self._auth_get)
+
+    def _auth_get(self, url: str):
+        return self.safe_get(url, reauth=False)
+
+    @staticmethod
+    def _stream_to_temp(resp: requests.Response, dirname: str) -> tuple:
+        """Write a streamed response to a temp file, checking its length. Returns (temp file, sha256, bytes).
+
+        The temp file is removed when the body can't be read in full, and the error is raised.
+        """
+        fd, tmp_file = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.part')
+        digest = hashlib.sha256()
+        written = 0
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+
+            content_length = resp.headers.get('Content-Length')
+            if content_length is not None and 'Content-Encoding' not in resp.headers and written != int(content_length):
+                raise PartialContentException(f'Partial response ({written} of {content_length} bytes)')
+            if written < THUMB_MIN_BYTES:
+                raise PartialContentException('Empty response')
+
+        except (OSError, requests.exceptions.RequestException, PartialContentException):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+        finally:
+            resp.close()
+
+        return tmp_file, digest.hexdigest(), written
+
+    def get_thumbs(self) -> ThumbIndex:
+        if self.thumbs is None:
+            self.thumbs = ThumbIndex()
+            self.thumbs.load()
+
+        return self.thumbs
+
+    def save_media(self, media: Media, overwrite: bool = True) -> bool:
         shortcode = media.shortcode
+        thumbs = self.get_thumbs()
 
         if not overwrite:
-            matches = glob(THUMB_DIR + shortcode + '.*')
+            saved = thumbs.get(shortcode)
         else:
-            matches = []
+            saved = None
 
-        if matches:
-            media.thumb_file = matches[0]
-
-            if len(matches) == 1:  # more checks here on size, or set saved on media
-                lo.d(f'{media.thumb_file} already saved, skipping.')
-            else:
-                lo.w(f'Found multiple files for {shortcode}: {", ".join(matches)}. Using {media.thumb_file}.')
+        if saved:
+            media.thumb_file = saved.path
+            lo.d(f'{media.thumb_file} already saved, skipping.')
 
         else:
             lo.d(f'Retrieving thumbnail for {shortcode}...')
 
-            img_data = self.safe_get(media.thumbnail_src, secs=SLEEP_DELAY_IMG)
-            if img_data is None:
-                #lo.w(f'Could not fetch {media.thumbnail_src}')
-                return
+            tries = 0
+            retry_delay = RETRY_DELAY
+
+            # the body is streamed after safe_get returns, so a cut short one is retried here with the same backoff
+            while True:
+                img_data = self.safe_get(media.thumbnail_src, stream=True)
+                if img_data is None:
+                    #lo.w(f'Could not fetch {media.thumbnail_src}')
+                    return False
+
+                ext = guess_extension(img_data.headers.get('content-type', '').partition(';')[0].strip())
+                if not ext:
+                    ext = ''
+                elif ext == '.jpe':
+                    ext = '.jpg'
+
+                #media.mimetype = ext
+                try:
+                    tmp_file, digest, written = self._stream_to_temp(img_data, thumbs.dirname)
+                    break
+                except (OSError, requests.exceptions.RequestException, PartialContentException) as e:
+                    # an OSError is our disk, fetching again won't help
+                    if isinstance(e, OSError) or tries >= MAX_RETRIES:
+                        lo.w(f'Could not save {media.thumbnail_src}: {repr(e)}')
+                        return False
+
+                    lo.w('Retrying after {} seconds for exception {} on {}...'.format(retry_delay, repr(e), media.thumbnail_src))
+                    self.metrics.inc('retries_total', endpoint='image', reason='error')
+                    self.metrics.inc('sleep_seconds_total', retry_delay, reason='retry')
+                    self._sleep(retry_delay)
+                    retry_delay *= 2
+                    tries += 1
 
-            ext = guess_extension(img_data.headers.get('content-type', '').partition(';')[0].strip())
-            if not ext:
-                ext = ''
-            elif ext == '.jpe':
-                ext = '.jpg'
+            media.thumb_file = thumbs.add(shortcode, tmp_file, digest, ext, written).path
+            self.metrics.inc('response_bytes_total', written, endpoint='image')
 
-            #media.mimetype = ext
-            media.thumb_file = THUMB_DIR + shortcode + ext
-            #media.content = img_data.content
+            lo.d(f'Saved {media.thumb_file}')
 
-            with open(media.thumb_file, 'wb') as f:
-                f.write(img_data.content)
+        return True
 
-            lo.d(f'Saved {media.thumb_file}')
+    def save_all_media(self, media_list: List[Media], workers: int = IMG_WORKERS, overwrite: bool = True) -> int:
+        """Download thumbnails concurrently, paced by the per-host image budgets of the rate limiter."""
+        start = time.perf_counter()
+
+        thumbs = self.get_thumbs()
+        deduped = thumbs.deduped
+
+        with self.metrics.timer('thumbnails', user=self.user), thumbs.locked(), ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            saved = sum(pool.map(lambda m: self.save_media(m, overwrite=overwrite), media_list))
+            thumbs.save()
+
+        self.metrics.inc('thumbnails_total', saved, result='saved')
+        self.metrics.inc('thumbnails_total', len(media_list) - saved, result='failed')
+
+        elapsed = time.perf_counter() - start
+        rate = saved / elapsed if elapsed > 0 else 0.0
+        lo.i(f'Saved {saved} of {len(media_list)} images in {elapsed:.1f}s ({rate:.1f} images/sec)')
+        if thumbs.deduped > deduped:
+            lo.i(f'{thumbs.deduped - deduped} images were already stored under another shortcode')
+
+        return saved
+
+    def missing_thumbs(self, media_list: List[Media]) -> List[Media]:
+        return self.get_thumbs().missing(media_list)
+
+    def wait_thumb_prefetch(self) -> int:
+        """Wait for thumbnails prefetched during the scrape, returning how many were saved."""
+        future, self.thumb_prefetch = self.thumb_prefetch, None
+        if future is None:
+            return 0
+
+        try:
+            return future.result()
+        except Exception as e:
+            lo.w(f'Thumbnail prefetch failed: {repr(e)}')
+            return 0
 
     def get_txt(self, url: str, is_json: bool = False, **kwargs) -> Optional[Union[dict, str]]:
         resp = self.safe_get(url, **kwargs)
@@ -331,83 +2118,75 @@ class InstaGet:
         else:
             return resp.text  # todo: json?
 
-    def auth(self):
-        self.session.headers.update({'Referer': BASE_URL, 'user-agent': STORIES_UA})
-        req = self.safe_get(BASE_URL)
-
-        if req:
-            self.session.headers.update({'X-CSRFToken': req.cookies['csrftoken']})
-            self.session.headers.update({'user-agent': USER_AGENT})
-
-            self.rhx_gis = ''
-            self.is_authed = True
-        else:
-            lo.e('Could not auth.')
-
-    def auth_user(self):
-        self.session.headers.update({'Referer': BASE_URL, 'user-agent': STORIES_UA})
-        req = self.safe_get(BASE_URL)
+    def get_store(self) -> MediaStore:
+        username = self.user or '_nouser'
+        if self.store is None or self.store.user != username:
+            if self.store is not None:
+                self.store.close()
+            self.store = MediaStore.open(username)
 
-        if req:
-            self.session.headers.update({'X-CSRFToken': req.cookies['csrftoken']})
+        return self.store
 
-            login_data = {'username': self.login_user, 'password': self.login_pass}
-            login = self.session.post(LOGIN_URL, data=login_data, allow_redirects=True)
+    def get_writer(self) -> StoreWriter:
+        username = self.user or '_nouser'
+        if self.writer is None or self.writer.user != username:
+            self.close_writer()
+            self.get_store()  # migrates legacy pickles before the writer opens the file
+            self.writer = StoreWriter(username)
 
-            self.session.headers.update({'X-CSRFToken': login.cookies['csrftoken']})
-            self.cookies = login.cookies
-            login_text = json.loads(login.text)
+        return self.writer
 
-            if login_text.get('authenticated') and login.status_code == 200:
-                self.logged_in = True
-                self.is_authed = True
-                self.session.headers.update({'user-agent': USER_AGENT})
-                self.rhx_gis = ""
-            else:
-                lo.e('Login failed for ' + self.login_user)
+    def close_writer(self):
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            self.metrics.inc('store_rows_total', writer.written)
+            try:
+                writer.close()
+            except sqlite3.Error as e:
+                lo.e(f'Store writes failed for {writer.user}: {repr(e)}')
 
-                if 'checkpoint_url' in login_text:
-                    checkpoint_url = login_text.get('checkpoint_url')
-                    lo.e('Please verify your account at ' + BASE_URL[0:-1] + checkpoint_url)
-                elif 'errors' in login_text:
-                    for count, error in enumerate(login_text['errors'].get('error')):
-                        count += 1
-                        lo.d('Session error %(count)s: "%(error)s"' % locals())
-                else:
-                    lo.e(json.dumps(login_text))
+    def _count_bytes(self, chunks, endpoint: str):
+        for chunk in chunks:
+            self.metrics.inc('response_bytes_total', len(chunk), endpoint=endpoint)
+            yield chunk
 
-    def to_pickle(self, data: dict, filename: str):
-        username = self.user or '_nouser'
-        dirname = PICKLE_DIR + username
-        if not os.path.exists(dirname):
-            os.mkdir(dirname)
+    @staticmethod
+    def _extract_shared_data(chunks) -> Optional[bytes]:
+        """Find the sharedData JSON in a stream of byte chunks, without reading past the end of its script."""
+        buf = bytearray()
+        found = False
+        searched = 0
+
+        for chunk in chunks:
+            buf += chunk
+
+            if not found:
+                idx = buf.find(SHARED_DATA_START)
+                if idx == -1:
+                    # keep enough of the tail to match a marker split across chunks
+                    del buf[:max(0, len(buf) - len(SHARED_DATA_START) + 1)]
+                    continue
+                del buf[:idx + len(SHARED_DATA_START)]
+                found = True
 
-        with open(f'{dirname}/{filename}.pkl', 'wb') as f:
-            pickle.dump(data, f)
+            end = buf.find(SHARED_DATA_END, max(0, searched - len(SHARED_DATA_END) + 1))
+            if end != -1:
+                return bytes(buf[:end])
+            searched = len(buf)
 
-    def load_pickle(self, filepath: str):
-        if '/' not in filepath:
-            username = self.user or '_nouser'
-            filepath = f'{PICKLE_DIR}{username}/{filepath.replace(".pkl","")}.pkl'
+        return None
 
-        if not os.path.exists(filepath):
-            lo.w(f'Could not find pickle for {filepath}')
+    def _decode_shared_data(self, shared_data: Optional[bytes]):
+        if shared_data is None:
+            lo.e('No sharedData in response')
             return
 
-        with open(filepath, 'rb') as f:
-            return pickle.load(f)
-
-    def get_shared_data(self, data: str):
-        if '_sharedData' in data:
-            try:
-                shared_data = data.split("window._sharedData = ")[1].split(";</script>")[0]
-                data_json = json.loads(shared_data)
-                self.rhx_gis = ''
-                return data_json
-            except (TypeError, KeyError, IndexError) as e:
-                lo.e(f'Exception {e} getting sharedData in response')
-        else:
-            lo.e('No sharedData in response')
+        try:
+            data_json = json.loads(shared_data)
+            self.rhx_gis = ''
+            return data_json
+        except ValueError as e:
+            lo.e(f'Exception {e} getting sharedData in response')
 
     @staticmethod
     def get_page_data(data: dict):
@@ -426,38 +2205,45 @@ class InstaGet:
         return profile_data
 
     @staticmethod
-    def convert_node(node: dict):
-        is_sidecar = node.get('__typename')
-        if is_sidecar == 'GraphSidecar':
-            lo.v(f'sidecar: {node.get("shortcode")}')
+    def convert_node(node: dict) -> Media:
+        get = node.get
+
+        if get('__typename') == 'GraphSidecar':
+            lo.v(f'sidecar: {get("shortcode")}')
             # get id, is_video, video_url, display_url
             # TODO change this function to yield media
             # need to grab edge_sidecar_to_children from details
 
-        info = {
-            k: node.get(k) for k in
-            ('id', 'shortcode', 'display_url', 'thumbnail_src', 'is_video', 'video_url', 'video_view_count',
-             #'accessibility_caption', 'dimensions', 'comments_disabled',
-             'location', 'taken_at_timestamp')
-        }
-
-        info['likes'] = node.get('edge_media_preview_like', {}).get('count')
-        #info['comments'] = node.get('edge_media_to_comment', {}).get('count')
-
         # todo: is this ever more than 1?
-        #       combine to comprehension
-        captions = []
-        for caption in node.get('edge_media_to_caption', {}).get('edges', []):
-            cap_txt = caption.get('node', {}).get('text')
-            if cap_txt is not None:
-                captions.append(cap_txt)
-
-        info['captions'] = captions
+        captions = [
+            cap_txt for cap_txt in (
+                caption.get('node', {}).get('text') for caption in get('edge_media_to_caption', {}).get('edges', [])
+            )
+            if cap_txt is not None
+        ]
+
+        return Media(
+            id=get('id'),
+            shortcode=get('shortcode'),
+            display_url=get('display_url'),
+            thumbnail_src=get('thumbnail_src'),
+            is_video=get('is_video'),
+            video_url=get('video_url'),
+            video_view_count=get('video_view_count'),
+            taken_at_timestamp=get('taken_at_timestamp'),
+            likes=get('edge_media_preview_like', {}).get('count'),
+            #comments=get('edge_media_to_comment', {}).get('count'),
+            captions=captions,
+            location=get('location')
+        )
 
-        return Media(**info)
+    @classmethod
+    def convert_nodes(cls, edges: List[dict]) -> List[Media]:
+        convert = cls.convert_node
+        return [convert(edge.get('node', {})) for edge in edges]
 
     def _get_media_details(self, shortcode: str):
-        resp = self.get_txt(VIEW_MEDIA_URL.format(shortcode), is_json=True, secs=SLEEP_DELAY_IMG)
+        resp = self.get_txt(VIEW_MEDIA_URL.format(shortcode), is_json=True)
 
         if not resp:
             lo.e('Failed to get media details for ' + shortcode)
@@ -492,7 +2278,7 @@ class InstaGet:
         if first:
             return ret
 
-        media_list: List[Media] = []
+        valid_edges: List[dict] = []
 
         for edge in edges:
             node = edge.get('node', {})
@@ -501,112 +2287,258 @@ class InstaGet:
             if fn == '_none':
                 lo.e(f'_none shortcode for {node}')
             else:
-                if self.get_location:
-                    n_miss_loc = node.get('location') is None
-                else:
-                    n_miss_loc = False
-                n_miss_vid = node.get('is_video') is True and node.get('video_url') is None
-                if n_miss_loc or n_miss_vid:
-                    details = self._get_media_details(fn)
+                valid_edges.append(edge)
 
-                    details_data = details.get('graphql', {}).get('shortcode_media', {})
-                    if n_miss_loc:
-                        node['location'] = details_data.get('location')
-                    if n_miss_vid:
-                        node['video_url'] = details_data.get('video_url')
+        media_list = self.convert_nodes(valid_edges)
 
-                fn = 'm_' + fn
+        to_enrich = []
+        for edge, info in zip(valid_edges, media_list):
+            node = edge['node']
+            n_miss_loc = self.get_location and node.get('location') is None
+            n_miss_vid = node.get('is_video') is True and node.get('video_url') is None
+            if n_miss_loc or n_miss_vid:
+                to_enrich.append((node, info))
 
-                # move under else?
-                self.to_pickle(node, fn)
+        self.enricher.enrich(to_enrich)
 
-                info = self.convert_node(node)
-
-                media_list.append(info)
+        self.get_writer().put_nodes([edge['node'] for edge in valid_edges])
 
         ret['media_list'] = media_list
 
         return ret
 
-    def save_cookies(self):
-        if self.cookiejar:
-            with open(self.cookiejar, 'wb') as f:
-                pickle.dump(self.session.cookies, f)
-
-    def update_ig_gis_header(self, params):
+    def ig_gis_header(self, params) -> Dict[str, str]:
+        # signs one query, so it goes with that request rather than on the session every worker shares
         data = self.rhx_gis + ":" + params
         ig_gis = hashlib.md5(data.encode()).hexdigest()
-        self.session.headers.update({'x-instagram-gis': ig_gis})
+        return {'x-instagram-gis': ig_gis}
 
-    def get_gql(self, qid, end_cursor):
+    def _fetch_gql(self, qid, end_cursor) -> dict:
         if end_cursor is None:
             params = GQL_VARS_FIRST.format(qid)
         else:
             params = GQL_VARS.format(qid, end_cursor)
 
-        self.update_ig_gis_header(params)
-
-        resp: dict = self.get_txt(GQL_URL.format(params), is_json=True)
+        resp: dict = self.get_txt(GQL_URL.format(params), is_json=True, headers=self.ig_gis_header(params))
         if not resp:
-            data = {}
-        else:
-            data = resp['data']['user']
+            return {}
+
+        return resp['data']['user']
+
+    @staticmethod
+    def reaches_cache(posts: List[tuple], known: Optional[set], since: Optional[int]) -> bool:
+        """Whether a page of (shortcode, taken_at_timestamp) posts reaches what the cache already has.
+
+        With since, that is the page's last post being no newer than it. Pinned posts at the top of the first page
+        are older than the posts after them, so they can't end the page on their own. Without since it is any
+        post being in known.
+        """
+        if not posts:
+            return False
+        if since is not None:
+            return (posts[-1][1] or 0) <= since
+        return bool(known) and any(shortcode in known for shortcode, _ in posts)
+
+    def iter_pages(
+        self, qid, max_pages: int, end_cursor: Optional[str], has_next: bool, known: set = None, since: int = None
+    ):
+        """Yield raw timeline pages as they arrive, following their cursors, up to the cache if known or since is given.
+
+        Only the page info and shortcodes are read here, so this can run ahead of conversion on its own thread.
+        """
+        pnum = 1
+
+        # do max items instead? or always 50, but 12 on first page
+        while pnum <= max_pages:
+            if not has_next:
+                lo.w('No more entries.')
+                break
+
+            lo.i(f'Parsing page {pnum} of {max_pages}...')
 
-        return self.get_media(data)
+            data = self._fetch_gql(qid, end_cursor)
+            media = data.get('edge_owner_to_timeline_media')
+            if not media or not media.get('edges'):
+                lo.w('No GQL data.')
+                break
+
+            page_info = media.get('page_info')
+            has_next = page_info['has_next_page']
+            end_cursor = page_info['end_cursor']
+
+            yield data
+            pnum += 1
+
+            nodes = [edge.get('node', {}) for edge in media['edges']]
+            if self.reaches_cache([(node.get('shortcode'), node.get('taken_at_timestamp')) for node in nodes], known, since):
+                lo.i('Reached cached media.')
+                break
 
     def fetch_profile(self):
+        """Stream the profile page and decode only its sharedData script."""
         lo.i('Parsing profile...')
         url = BASE_URL + self.user + '/'
 
-        resp = self.get_txt(url)
-        #if resp is None:
-        #    lo.e('Could not fetch profile')
-        return resp
+        resp = self.safe_get(url, stream=True)
+        if resp is None:
+            lo.e(f'No data for {url}')
+            return None
+
+        from_cache = getattr(resp, 'from_cache', False)
+        chunks = resp.iter_content(CHUNK_SIZE)
+        if not from_cache:
+            chunks = self._count_bytes(chunks, 'profile')
+
+        try:
+            shared_data = self._extract_shared_data(chunks)
+
+            # closing a half read response closes its socket, a short rest is cheaper to read than a new connection
+            drained = 0
+            for chunk in chunks:
+                drained += len(chunk)
+                if drained > PROFILE_DRAIN_MAX:
+                    break
+        except requests.exceptions.RequestException as e:
+            lo.e(f'Exception {repr(e)} reading {url}')
+            return None
+        finally:
+            resp.close()
+
+        # only the script is cached, it is all we read of the page
+        if shared_data is not None and not from_cache:
+            self.http_cache.put(url, resp, body=b'<script>' + SHARED_DATA_START + shared_data + SHARED_DATA_END)
 
-    def fetch_media(self, profile_id: str, max_pages: int, page_data: dict):
+        return self._decode_shared_data(shared_data)
+
+    def _update_sync_state(self, media_list: List[Media], has_next: bool, end_cursor: Optional[str], track_cursor: bool):
+        state = self.sync_state
+
+        timestamps = [m.taken_at_timestamp for m in media_list if m.taken_at_timestamp]
+        if timestamps:
+            state['newest_timestamp'] = max(state.get('newest_timestamp') or 0, max(timestamps))
+
+        if track_cursor or 'end_cursor' not in state:
+            state['end_cursor'] = end_cursor
+            state['has_next_page'] = has_next
+
+        self.get_writer().set_meta('state', state)
+
+    def fetch_media(
+        self, profile_id: str, max_pages: int, page_data: dict,
+        end_cursor: str = None, known: set = None, track_cursor: bool = True, since: int = None
+    ):
+        """Fetch timeline pages starting at end_cursor.
+
+        Stops after the first page that reaches the cache, see reaches_cache. The saved cursor only
+        moves when track_cursor is set, so fetching the newest posts never loses our place in the history.
+        """
         first_page_data = self.get_media(page_data, first=True)
 
         total_items = first_page_data['count']
-        has_next = first_page_data['has_next_page']
-        end_cursor = None
+        if end_cursor is None:
+            has_next = first_page_data['has_next_page']
+        else:
+            has_next = True
 
         lo.i(f'{total_items:,} total items')
 
-        actual_pages = math.ceil(total_items / 50)
-        if actual_pages < max_pages:
-            lo.w(f'Lowering total pages from {max_pages} to {actual_pages}')
-            max_pages = actual_pages
+        # fetching new posts stops at the cache, not at a page count
+        if end_cursor is None and not known:
+            actual_pages = math.ceil(total_items / 50)
+            if actual_pages < max_pages:
+                lo.w(f'Lowering total pages from {max_pages} to {actual_pages}')
+                max_pages = actual_pages
 
         all_media: List[Media] = []
-        pnum = 1
+        self.page_stop = (end_cursor, has_next, False)
 
-        # do max items instead? or always 50, but 12 on first page
-        while pnum <= max_pages:
-            if not has_next:
-                lo.w('No more entries.')
-                break
+        # pages are fetched ahead on their own thread while earlier ones are converted, enriched and written
+        with self.metrics.timer('pages', user=self.user):
+            pages = iter_ahead(
+                self.iter_pages(profile_id, max_pages, end_cursor, has_next, known=known, since=since), PAGE_PREFETCH
+            )
+            try:
+                for data in pages:
+                    gql_data = self.get_media(data)
+                    if not gql_data:
+                        lo.w('No GQL data.')
+                        break
+
+                    page_media: List[Media] = gql_data['media_list']
+                    all_media += page_media
+
+                    self._update_sync_state(page_media, gql_data['has_next_page'], gql_data['end_cursor'], track_cursor)
+                    reached = self.reaches_cache([(m.shortcode, m.taken_at_timestamp) for m in page_media], known, since)
+                    self.page_stop = (gql_data['end_cursor'], gql_data['has_next_page'], reached)
+                    self.pages_fetched += 1
+                    self.metrics.inc('pages_total')
+                    self.enricher.collect()
+            finally:
+                pages.close()
+
+        enricher = self.enricher
+        if enricher.pending:
+            lo.i(f'Waiting for media details ({len(enricher.pending)})...')
+        with self.metrics.timer('details_wait', user=self.user):
+            enricher.collect(wait=True)
+        with self.metrics.timer('store_flush', user=self.user):
+            self.get_writer().flush()
 
-            lo.i(f'Parsing page {pnum} of {max_pages}...')
+        lo.i('Done parsing')
+        if enricher.fetched or enricher.cached or enricher.failed:
+            lo.i(f'Media details: {enricher.fetched} fetched, {enricher.cached} cached, {enricher.failed} failed')
 
-            gql_data = self.get_gql(profile_id, end_cursor)
-            if not gql_data:
-                lo.w('No GQL data.')
+        return all_media
+
+    def fetch_new(self, profile_id: str, max_pages: int, page_data: dict, known: set) -> List[Media]:
+        """Fetch posts newer than the cache, then fill the gaps earlier runs left above it.
+
+        Paging from the top stops at posts no newer than the newest cached one, gaps stop at any cached post.
+        A run that runs out of pages before reaching cached media saves where it stopped in new_cursors,
+        newest gap first, and later runs continue from there within the same max_pages.
+        """
+        state = self.sync_state
+        # read before paging moves it
+        since = state.get('newest_timestamp')
+        starts = [None] + list(state.get('new_cursors') or [])
+        gaps = []
+        all_media: List[Media] = []
+
+        for i, cursor in enumerate(starts):
+            if max_pages <= 0:
+                gaps += [c for c in starts[i:] if c]
                 break
 
-            all_media += gql_data['media_list']
+            if cursor is not None:
+                lo.i(f'Filling a gap left by an earlier run ({len(starts) - i} left)...')
 
-            has_next = gql_data['has_next_page']
-            end_cursor = gql_data['end_cursor']
+            pages_before = self.pages_fetched
+            all_media += self.fetch_media(
+                profile_id, max_pages, page_data, end_cursor=cursor, known=known, track_cursor=False,
+                since=since if cursor is None else None
+            )
+            max_pages -= self.pages_fetched - pages_before
 
-            pnum += 1
+            end_cursor, has_next, reached = self.page_stop
+            if end_cursor and has_next and not reached:
+                gaps.append(end_cursor)
 
-        lo.i('Done parsing')
+        if gaps:
+            lo.w(f'{len(gaps)} gaps above the cache left for the next run')
+        if gaps or state.get('new_cursors'):
+            state['new_cursors'] = gaps
+            self.get_writer().set_meta('state', state)
 
         return all_media
 
     def scrape(
-        self, user: str = None, max_pages: int = MAX_PAGES, max_images: int = MAX_IMGS, overwrite: bool = False, get_location: bool = False
+        self, user: str = None, max_pages: int = MAX_PAGES, max_images: int = MAX_IMGS, overwrite: bool = False, get_location: bool = False,
+        sync: str = 'auto', rank: str = 'likes', prefetch_thumbs: bool = False, img_workers: int = IMG_WORKERS
     ):
+        # reset first, the stats of a user that fails early must not be the previous user's
+        self.pages_fetched = 0
+        self.enricher.reset()
+
         if not user:
             user = self.user
             if not user:
@@ -615,187 +2547,588 @@ class InstaGet:
         else:
             self.user = user
 
-        lo.i('Authing...')
-
-        if self.login_user and self.login_pass:
-            self.auth_user()
-        else:
-            self.auth()
-
-        if not self.is_authed:
+        if not self.authenticate():
             return
 
         self.get_location = get_location
 
+        store = self.get_store()
+
         if overwrite:
-            shared_data = None
             page_data: dict = {}
-            all_media: List[Media] = []
+            known = set()
+            self.sync_state = {}
+            sync = 'full'
         else:
             lo.i('Loading cached data...')
-            shared_data = None
-            page_data = self.load_pickle('profile')
-            all_media = [
-                self.convert_node(
-                    self.load_pickle(fn)
-                )
-                for fn in glob(f'{PICKLE_DIR}{user}/m_*.pkl')
-            ]
+            page_data = store.get_meta('profile')
+            known = store.shortcodes()
+            self.sync_state = store.get_meta('state') or {}
+
+        # the cached profile is only a fallback, counts and the first page have to be current
+        with self.metrics.timer('profile', user=self.user):
+            shared_data = self.fetch_profile()
+        fresh_data = self.get_page_data(shared_data) if shared_data else None
+
+        if isinstance(fresh_data, dict):
+            page_data = fresh_data
+            store.set_meta('profile', page_data)
+        elif page_data:
+            lo.w('Could not refresh the profile, using the cached one')
+        else:
+            return
 
-        if not page_data:
-            resp = self.fetch_profile()
-            if resp is None:
-                return
+        profile_data = self.convert_profile(page_data)
+        lo.v('\n' + pformat(profile_data, indent=4))
 
-            shared_data = self.get_shared_data(resp)
-            page_data = self.get_page_data(shared_data)
-            if not isinstance(page_data, dict):
-                return
+        if sync == 'auto' and not known:
+            sync = 'full'
 
-            self.to_pickle(page_data, 'profile')
+        if sync == 'older' and not self.sync_state.get('end_cursor'):
+            lo.w('No saved cursor, fetching from the first page')
+            sync = 'full'
 
-        profile_data = self.convert_profile(page_data)
-        lo.v('\n' + pformat(profile_data, indent=4))
+        profile_id = profile_data['id']
+        fetched: Dict[str, Media] = {}
 
-        # todo technically wrong if max images too high, past last page
-        #   also if max imgs is 250, request 10 then 11, skips
-        if not all_media or len(all_media) < max_images:
-            if not shared_data:
-                resp = self.fetch_profile()
-                if resp is None:
-                    return
-                shared_data = self.get_shared_data(resp)
-                if not shared_data:
-                    return
+        if prefetch_thumbs and known and max_images:
+            # most cached top items stay on top, so their thumbnails are downloaded while new pages come in
+            cached_top = self.load_cached_media(max_images, rank=rank)
+            self.thumb_prefetch = self.thumb_stage.submit(
+                lambda: self.save_all_media(self.missing_thumbs(cached_top), workers=img_workers)
+            )
 
-            profile_id = profile_data['id']
-            all_media = self.fetch_media(profile_id, max_pages, page_data)
+        if sync in ('auto', 'new'):
+            lo.i(f'Fetching posts newer than the cache ({len(known):,} items)...')
+            media = self.fetch_new(profile_id, max_pages, page_data, known)
+            fetched.update((m.shortcode, m) for m in media)
+            lo.i(f'{len(fetched.keys() - known):,} new items')
 
-        return profile_data, all_media
+            # todo technically wrong if max images too high, past last page
+            if sync == 'auto' and len(known | fetched.keys()) < max_images and self.sync_state.get('has_next_page'):
+                sync = 'older'
 
-    def gen_html(self, _prof: dict, media_sort: List[Media], rows, size, template_name = HTML_TEMPLATE):
-        lo.i('Creating html...')
+        if sync == 'older':
+            if not self.sync_state.get('has_next_page'):
+                lo.i('Cached history is complete')
+            else:
+                lo.i('Continuing older history from the saved cursor...')
+                media = self.fetch_media(
+                    profile_id, max_pages, page_data, end_cursor=self.sync_state['end_cursor']
+                )
+                fetched.update((m.shortcode, m) for m in media)
 
-        env = self.jinja_env
-        template = env.get_template(f'{template_name}.html')
-        re_html = re.compile(r'^{}'.format(HTML_DIR))
+        elif sync == 'full':
+            media = self.fetch_media(profile_id, max_pages, page_data)
+            fetched.update((m.shortcode, m) for m in media)
 
-        if size == 'sm':
-            #TODO this depends on screen resolution
-            max_items = rows * 7  # 5 for 1080p
+        if overwrite:
+            all_media = list(fetched.values())
         else:
-            max_items = rows * 5  # 4 for 1080p
-            if size != 'md':
-                lo.e('Invalid size, using "md"')
+            with self.metrics.timer('cache_load', user=self.user):
+                all_media = self.load_cached_media(max_images, fetched, rank=rank)
 
-        all_data = []
-        for m in media_sort:
-            str_date = datetime.utcfromtimestamp(m.taken_at_timestamp).strftime('%b %d, %y')
+        return profile_data, all_media
 
-            if m.thumb_file:
-                thumb_url = re_html.sub('', m.thumb_file)
-            else:
-                thumb_url = m.thumbnail_src
+    def load_cached_media(self, max_images: Optional[int], fetched: Dict[str, Media] = None, rank: str = 'likes') -> List[Media]:
+        return cached_media(self.get_store(), max_images, fetched, rank=rank)
 
-            # TODO hide if cant find this link
-            if m.is_video:
-                display_url = m.video_url
+    @staticmethod
+    def html_rows(media: List[Media]) -> List[dict]:
+        """Template rows for media, in one pass."""
+        html_dir = HTML_DIR
+        prefix_len = len(html_dir)
+        rows = []
+        append = rows.append
+
+        for m in media:
+            thumb_file = m.thumb_file
+            if not thumb_file:
+                thumb_url = m.thumbnail_src
+            elif thumb_file.startswith(html_dir):
+                thumb_url = thumb_file[prefix_len:]
             else:
-                display_url = m.display_url
+                thumb_url = thumb_file
 
-            caption = '<br />'.join(
-                cap.strip()[:max(0, MAX_CAPTION - 3)] + ' [...]' if len(cap.strip()) > MAX_CAPTION else cap.strip()
-                for cap in m.captions
-            )
+            # TODO hide if cant find this link
+            display_url = m.video_url if m.is_video else m.display_url
 
-            if isinstance(m.location, dict):
-                location = m.location.get('name')
+            location = m.location
+            if isinstance(location, dict):
+                location = location.get('name')
             else:
                 location = None
 
             # todo add more data
 
-            all_data.append({
+            append({
                 'big_url': display_url,
                 'save_url': display_url,
                 'small_url': thumb_url,
-                'caption': caption,
+                'caption': format_caption(m.captions),
                 'likes': m.likes,
-                'date': str_date,
+                'date': format_day(m.taken_at_timestamp // DAY_SECS),
                 'is_video': m.is_video,
                 'video_views': m.video_view_count,
                 'location': location
             })
 
-        if not all_data:
-            lo.w('No media to display.')
-        else:
-            return template.render(
-                all_data=all_data, user=self.user, max_items=max_items, grid_type=size
-            )
+        return rows
 
+    def gen_html(
+        self, _prof: dict, media_sort: List[Media], rows, size, template_name = HTML_TEMPLATE, paged: bool = False,
+        only: Optional[set] = None
+    ) -> Optional[Dict[str, str]]:
+        return gen_html(self.user, media_sort, rows, size, template_name=template_name, paged=paged, only=only)
 
 
-def main(
-    username: List[str], overwrite: bool, no_save_imgs: bool, max_pages: int, max_images: int, rows: int, size: str, get_location: bool, log_level: str, **_kw
-):
-    #todo allow int
-    log_level = log_level.upper()
-    if log_level != DEFAULT_LOGLEVEL:
-        lo.set_level(log_level)
+def cached_media(store: MediaStore, max_images: Optional[int], fetched: Dict[str, Media] = None, rank: str = 'likes') -> List[Media]:
+    """Select the top cached items by rank from their sort keys, then build Media only for those.
+
+    Items already in fetched are reused instead of being read back from the store.
+    """
+    fetched = fetched or {}
+
+    keys = store.load_keys()
+    lo.i(f'{len(keys):,} cached items')
+
+    if max_images is None:
+        max_images = len(keys)
+    shortcodes = keys.top(max_images, rank=rank)
+
+    nodes = store.get_nodes([sc for sc in shortcodes if sc not in fetched])
+    convert = InstaGet.convert_node
+
+    return [fetched[sc] if sc in fetched else convert(nodes[sc]) for sc in shortcodes]
+
+
+@lru_cache(maxsize=None)
+def jinja_env(template_dir: str) -> Environment:
+    from jinja2 import Environment, FileSystemLoader
+
+    # templates are compiled once per process and not checked for changes after that
+    return Environment(
+        loader=FileSystemLoader(template_dir),
+        trim_blocks=True,
+        lstrip_blocks=True,
+        auto_reload=False
+    )
+
+
+def get_template(name: str):
+    return jinja_env(TEMPLATE_DIR).get_template(f'{name}.html')
+
+
+@lru_cache(maxsize=4096)
+def format_day(day: int) -> str:
+    return datetime.utcfromtimestamp(day * DAY_SECS).strftime('%b %d, %y')
+
 
-    scraper = InstaGet(cookiejar=COOKIE_NAME)
+def format_caption(captions: List[str]) -> str:
+    parts = []
+    for cap in captions:
+        cap = cap.strip()
+        if len(cap) > MAX_CAPTION:
+            cap = cap[:max(0, MAX_CAPTION - 3)] + ' [...]'
+        parts.append(cap)
 
-    for user in username:
-        lo.s(f'Running for {user}')
-        scraper.user = user
+    return '<br />'.join(parts)
 
-        total_possible_imgs = max_pages * 50
-        if max_images > total_possible_imgs:
-            lo.w(f'Lowering max images from {max_images} to {total_possible_imgs}')
-            max_images = total_possible_imgs
 
-        data = scraper.scrape(max_pages=max_pages, max_images=max_images, overwrite=overwrite, get_location=get_location)
-        scraper.save_cookies()
+def section_size(rows: int, size: str) -> int:
+    if size == 'sm':
+        #TODO this depends on screen resolution
+        return rows * 7  # 5 for 1080p
+
+    return rows * 5  # 4 for 1080p
+
+
+def section_path(user: str, section: int) -> str:
+    return f'{SECTIONS_DIRNAME}{user}/section-{section}.html'
+
+
+def gen_html(
+    user: str, media_sort: List[Media], rows, size, template_name = HTML_TEMPLATE, paged: bool = False,
+    only: Optional[set] = None
+) -> Optional[Dict[str, str]]:
+    """Render the page, returning its files by path under HTML_DIR.
+
+    When paged, the page only holds the layout and each section is its own file, fetched by main.js when opened.
+    Only the paths in only are rendered when it is given.
+    """
+    lo.i('Creating html...')
+
+    template = get_template(template_name)
+
+    if size not in ('sm', 'md'):
+        lo.e('Invalid size, using "md"')
+    max_items = section_size(rows, size)
+
+    if not media_sort:
+        lo.w('No media to display.')
+        return None
+
+    files: Dict[str, str] = {}
+    section_urls: List[str] = []
+    all_data: List[dict] = []
+
+    if paged:
+        section_template = get_template(SECTION_TEMPLATE)
+        for n in range(0, len(media_sort), max_items):
+            url = section_path(user, n // max_items + 1)
+            section_urls.append(url)
+            if only is None or url in only:
+                section_data = InstaGet.html_rows(media_sort[n:n + max_items])
+                files[url] = section_template.render(all_data=section_data, offset=n)
+    else:
+        all_data = InstaGet.html_rows(media_sort)
+
+    page = f'{user}.html'
+    if only is None or page in only:
+        files[page] = template.render(
+            all_data=all_data, data_len=len(media_sort), user=user, max_items=max_items, grid_type=size,
+            section_urls=section_urls
+        )
+
+    return files
+
+
+def html_fingerprints(
+    user: str, media_sort: List[Media], rows: int, size: str, paged: bool, template_name: str = HTML_TEMPLATE
+) -> Dict[str, str]:
+    """Digest of what goes into each output file, by path under HTML_DIR.
+
+    Covers the template rows of the items shown, the layout options and the template mtimes,
+    so a file whose digest is unchanged would render the same.
+    """
+    mtimes = []
+    for name in (template_name, SECTION_TEMPLATE, '_item'):
+        filename = os.path.join(TEMPLATE_DIR, f'{name}.html')
+        mtimes.append(os.stat(filename).st_mtime_ns if os.path.exists(filename) else None)
+
+    layout = repr((user, rows, size, paged, mtimes)).encode()
+    max_items = section_size(rows, size)
+
+    def digest(items: List[Media], offset: int) -> str:
+        h = hashlib.sha256(layout)
+        h.update(str(offset).encode())
+        # the rows are all the templates read of an item, so any change that shows is hashed
+        for row in InstaGet.html_rows(items):
+            h.update(repr(tuple(row.values())).encode())
+        return h.hexdigest()
+
+    page = f'{user}.html'
+    if not paged:
+        return {page: digest(media_sort, 0)}
+
+    fingerprints = {
+        section_path(user, n // max_items + 1): digest(media_sort[n:n + max_items], n)
+        for n in range(0, len(media_sort), max_items)
+    }
+    # the page itself only lists the sections
+    fingerprints[page] = hashlib.sha256(layout + repr(len(media_sort)).encode()).hexdigest()
+
+    return fingerprints
+
+
+def write_html(user: str, files: Dict[str, str], keep=None):
+    """Atomically write rendered files under HTML_DIR, removing sections of the user that are not in keep.
+
+    keep defaults to the written files.
+    """
+    keep = set(files if keep is None else keep)
+
+    sections_dir = f'{HTML_DIR}{SECTIONS_DIRNAME}{user}/'
+    if os.path.isdir(sections_dir):
+        for name in os.listdir(sections_dir):
+            if f'{SECTIONS_DIRNAME}{user}/{name}' not in keep:
+                os.remove(sections_dir + name)
+
+    for path, content in files.items():
+        atomic_write(HTML_DIR + path, content)
+
+
+def update_html(store: MediaStore, user: str, media_sort: List[Media], rows: int, size: str, paged: bool, overwrite: bool):
+    """Render and write the files of the user's page whose fingerprints changed since the last run."""
+    fingerprints = html_fingerprints(user, media_sort, rows, size, paged)
+    previous = {} if overwrite else (store.get_meta('html') or {})
+    changed = {
+        path for path, digest in fingerprints.items()
+        if previous.get(path) != digest or not os.path.exists(HTML_DIR + path)
+    }
+
+    if not changed:
+        lo.i(f'HTML is up to date: http://127.0.0.1:9999/{user}.html')
+        return
+
+    html = gen_html(user, media_sort, rows, size, paged=paged, only=changed)
+
+    if html:
+        write_html(user, html, keep=fingerprints)
+        store.set_meta('html', fingerprints)
+        if paged:
+            lo.i(f'Wrote {len(html)} of {len(fingerprints)} files')
+        lo.s(f'Wrote file: http://127.0.0.1:9999/{user}.html')
+
+
+def scrape_user(
+    scraper: InstaGet, user: str, overwrite: bool, no_save_imgs: bool, max_pages: int, max_images: int, img_workers: int,
+    sync: str, rows: int, rank: str, size: str, paged: bool, get_location: bool
+) -> dict:
+    lo.s(f'Running for {user}')
+    scraper.user = user
+
+    stats = {'user': user, 'status': 'failed', 'pages': 0, 'items': 0, 'images': 0, 'elapsed': 0.0}
+    start = time.perf_counter()
+
+    # a user's cache has one writer, other processes skip it rather than race on its cursor
+    user_lock = FileLock(PICKLE_DIR + user + LOCK_EXT)
+    if not user_lock.acquire(blocking=False):
+        lo.w(f'{user} is being scraped by another process, skipping')
+        stats['status'] = 'busy'
+        return stats
+
+    try:
+        data = scraper.scrape(
+            max_pages=max_pages, max_images=max_images, overwrite=overwrite, get_location=get_location, sync=sync, rank=rank,
+            prefetch_thumbs=not no_save_imgs, img_workers=img_workers
+        )
+        scraper.sessions.save()
+        stats['pages'] = scraper.pages_fetched
+        stats['images'] = scraper.wait_thumb_prefetch()
 
         if data is None:
-            return
+            return stats
 
         prof, media = data
 
         lo.i(f'Found {len(media)} items.')
+        stats['items'] = len(media)
 
-        media_sort = sorted(media, key=lambda x: x.likes, reverse=True)
-        if max_images is not None:
-            media_sort = media_sort[:max_images]
+        media_sort = rank_media(media, max_images, rank=rank)
 
         if not no_save_imgs:
-            to_save: List[Media] = []
-            for m in media_sort:
-                shortcode = m.shortcode
-                fmatch = glob(THUMB_DIR + shortcode + '.*')
-                if not fmatch:
-                    to_save.append(m)
-                else:
-                    m.thumb_file = fmatch[0]
+            to_save = scraper.missing_thumbs(media_sort)
 
             if not to_save:
                 lo.i('No new images to save')
             else:
                 lo.i(f'Saving images ({len(to_save)})...')
 
-                for m in to_save:
-                    # TODO print stdout
-                    scraper.save_media(m)
+                stats['images'] += scraper.save_all_media(to_save, workers=img_workers)
+
+        with scraper.metrics.timer('html', user=user):
+            update_html(scraper.get_store(), user, media_sort, rows, size, paged, overwrite)
+
+        stats['status'] = 'ok'
+
+    except Exception as e:
+        lo.e(f'Scrape failed for {user}: {repr(e)}')
+        stats['status'] = 'error'
+
+    finally:
+        scraper.wait_thumb_prefetch()
+        scraper.close_writer()
+        user_lock.release()
+        stats['elapsed'] = time.perf_counter() - start
+
+    return stats
+
+
+def render_user(
+    user: str, thumbs: Optional[ThumbIndex], metrics: Metrics, overwrite: bool, max_images: int, rows: int, rank: str, size: str,
+    paged: bool
+) -> dict:
+    """Rebuild the user's HTML from their cache alone, without logging in or sending any request.
+
+    Thumbnails come from thumbs, media without one link to instagram. Without thumbs they all do.
+    """
+    lo.s(f'Rendering {user}')
+
+    stats = {'user': user, 'status': 'failed', 'pages': 0, 'items': 0, 'images': 0, 'elapsed': 0.0}
+    start = time.perf_counter()
+
+    if not os.path.exists(PICKLE_DIR + user + STORE_EXT) and not os.path.isdir(PICKLE_DIR + user):
+        lo.w(f'Nothing cached for {user}, skipping')
+        stats['status'] = 'empty'
+        return stats
+
+    user_lock = FileLock(PICKLE_DIR + user + LOCK_EXT)
+    if not user_lock.acquire(blocking=False):
+        lo.w(f'{user} is being scraped by another process, skipping')
+        stats['status'] = 'busy'
+        return stats
+
+    store = None
+    try:
+        store = MediaStore.open(user)
+
+        with metrics.timer('cache_load', user=user):
+            media = cached_media(store, max_images, rank=rank)
+
+        stats['items'] = len(media)
+        media_sort = rank_media(media, max_images, rank=rank)
+
+        if thumbs is not None:
+            missing = thumbs.missing(media_sort)
+            if missing:
+                lo.i(f'{len(missing)} items have no saved thumbnail, linking to instagram')
 
-        html = scraper.gen_html(prof, media_sort, rows, size)
+        with metrics.timer('html', user=user):
+            update_html(store, user, media_sort, rows, size, paged, overwrite)
+
+        stats['status'] = 'ok'
+
+    except Exception as e:
+        lo.e(f'Render failed for {user}: {repr(e)}')
+        stats['status'] = 'error'
+
+    finally:
+        if store is not None:
+            store.close()
+        user_lock.release()
+        stats['elapsed'] = time.perf_counter() - start
+
+    return stats
+
+
+def log_summary(all_stats: List[dict]):
+    width = max(len('User'), *(len(st['user']) for st in all_stats))
+
+    lo.i(f'{"User":<{width}}  {"Status":<6}  {"Pages":>5}  {"Items":>6}  {"Images":>6}  {"Elapsed":>8}')
+    for st in all_stats:
+        lo.i(
+            f'{st["user"]:<{width}}  {st["status"]:<6}  {st["pages"]:>5,}  {st["items"]:>6,}  {st["images"]:>6,}  {st["elapsed"]:>7.1f}s'
+        )
+
+
+def cached_users() -> List[str]:
+    """Users with a cache, including pickle directories not yet imported."""
+    users = {os.path.basename(path)[:-len(STORE_EXT)] for path in glob(PICKLE_DIR + '*' + STORE_EXT)}
+    users.update(os.path.basename(os.path.dirname(path)) for path in glob(PICKLE_DIR + '*/'))
+
+    return sorted(users)
+
+
+def cached_shortcodes() -> set:
+    """Shortcodes of every user's cached media, including pickle directories not yet imported."""
+    shortcodes = set()
+
+    for path in glob(PICKLE_DIR + '*' + STORE_EXT):
+        store = MediaStore(os.path.basename(path)[:-len(STORE_EXT)])
+        shortcodes |= store.shortcodes()
+        store.close()
+
+    for path in glob(PICKLE_DIR + '*/m_*.pkl'):
+        shortcodes.add(os.path.basename(path)[2:-len('.pkl')])
+
+    return shortcodes
+
+
+def run_gc_thumbs(thumbs: ThumbIndex):
+    lo.i('Removing unused thumbnails...')
+    # waits for other processes to finish saving thumbnails, so their new shortcodes are cached before we look
+    with thumbs.locked(shared=False):
+        shortcodes, blobs, freed = thumbs.gc(cached_shortcodes())
+    lo.s(f'Removed {shortcodes:,} thumbnail links and {blobs:,} files ({freed / 1024 / 1024:,.1f} MB)')
+
+
+def main(
+    username: List[str], overwrite: bool, no_save_imgs: bool, gc_thumbs: bool, render: bool, max_pages: int, max_images: int, img_workers: int,
+    user_workers: int, http2: bool, sync: str, rows: int, rank: str, size: str, paged: bool, report: Optional[str],
+    metrics_file: Optional[str], profile: Optional[str], get_location: bool, log_level: str, **_kw
+):
+    #todo allow int
+    log_level = log_level.upper()
+    if log_level != DEFAULT_LOGLEVEL:
+        lo.set_level(log_level)
+
+    if render and not username:
+        username = cached_users()
+        lo.i(f'Rendering all {len(username):,} cached users')
+
+    if not username and not gc_thumbs:
+        lo.e('No username given.')
+        return
+
+    total_possible_imgs = max_pages * 50
+    if not render and max_images > total_possible_imgs:
+        lo.w(f'Lowering max images from {max_images} to {total_possible_imgs}')
+        max_images = total_possible_imgs
+
+    workers = max(1, min(user_workers, len(username)))
+
+    profiler = None
+    if profile:
+        # allocations are process wide, so users run one at a time to keep them apart
+        lo.i(f'Profiling stages into {profile}, one user at a time')
+        profiler = Profiler(profile)
+        workers = 1
+
+    metrics = Metrics(profiler=profiler)
+    thumbs = ThumbIndex()
+    if not no_save_imgs or gc_thumbs:
+        thumbs.load()
+
+    if render:
+        rate_limiter = transport = http_cache = None
+
+        def run(user: str) -> dict:
+            with metrics.profile_user(user):
+                return render_user(
+                    user, None if no_save_imgs else thumbs, metrics, overwrite=overwrite, max_images=max_images, rows=rows,
+                    rank=rank, size=size, paged=paged
+                )
+
+    else:
+        # one scraper per worker thread, all paced by the same rate limiter and sharing one authenticated session
+        # over one connection pool, sized for every download and details worker at once
+        rate_limiter = RateLimiter()
+        transport = make_transport(workers * (img_workers + DETAILS_WORKERS + POOL_SLACK), http2=http2)
+        sessions = SessionManager(SESSION_NAME, transport=transport)
+        sessions.load()
+        http_cache = ResponseCache()
+        local = threading.local()
+
+        def run(user: str) -> dict:
+            scraper = getattr(local, 'scraper', None)
+            if scraper is None:
+                scraper = local.scraper = InstaGet(
+                    rate_limiter=rate_limiter, thumbs=thumbs, http_cache=http_cache, transport=transport, metrics=metrics,
+                    sessions=sessions
+                )
+
+            with metrics.profile_user(user):
+                return scrape_user(
+                    scraper, user, overwrite=overwrite, no_save_imgs=no_save_imgs, max_pages=max_pages, max_images=max_images,
+                    img_workers=img_workers, sync=sync, rows=rows, rank=rank, size=size, paged=paged, get_location=get_location
+                )
 
-        if html:
-            filename = HTML_DIR + user + '.html'
-            with open(filename, 'w') as f:
-                f.writelines(html)
-                lo.s(f'Wrote file: http://127.0.0.1:9999/{user}.html')
-                lo.i('(make sure python is running with: cd ~/dev/instagram/html && python -m http.server 9999 --bind 127.0.0.1')
+    with metrics.timer('run'), ThreadPoolExecutor(max_workers=workers) as pool:
+        all_stats = list(pool.map(run, username))
+
+    if gc_thumbs:
+        run_gc_thumbs(thumbs)
+
+    if all_stats:
+        log_summary(all_stats)
+        if not render:
+            lo.i('Request rates: ' + ', '.join(f'{k} {v:.2f}/s' for k, v in sorted(rate_limiter.current_rates().items())))
+            lo.i(f'HTTP cache: {http_cache.hits} hits, {http_cache.revalidated} revalidated, {http_cache.misses} misses')
+            log_connection_stats(transport)
+        lo.i('(make sure python is running with: cd ~/dev/instagram/html && python -m http.server 9999 --bind 127.0.0.1')
+
+    for st in all_stats:
+        metrics.inc('users_total', status=st['status'])
+    if http_cache is not None:
+        for result, count in (('hit', http_cache.hits), ('revalidated', http_cache.revalidated), ('miss', http_cache.misses)):
+            metrics.inc('http_cache_total', count, result=result)
+    if rate_limiter is not None:
+        for bucket, rate in rate_limiter.current_rates().items():
+            metrics.set('rate_limit_rps', rate, bucket=bucket)
+    metrics.write(report_file=report, prom_file=metrics_file)
+    if profiler:
+        profiler.write()
 
     lo.s('Done')
 
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+"""Offline benchmarks for the instagram scraper."""
+
+__version__ = 1.1
+DEFAULT_LOGLEVEL = 'WARNING'
+
+# default synthetic posts per benchmark
+BENCH_NODES = {
+    'media': 50000,
+    'scrape': 10000,
+    'html': 10000
+}
+BENCH_USER = 'bench'
+
+
+from my_utils.parsing import parser_init
+
+def parse_args():
+    parser = parser_init(
+        description=__doc__,
+        usage='%(prog)s [options] [benchmark ...]',
+        log_level=DEFAULT_LOGLEVEL,
+        version=__version__
+    )
+
+    parser.add_argument(
+        'benchmark', nargs='*', type=str, metavar='benchmark',
+        help='Benchmarks to run (default: all)\nChoices: {%s}' % ', '.join(BENCH_NODES)
+    )
+    parser.add_argument(
+        '-n', '--nodes', type=int, metavar='<num>',
+        help='Synthetic posts per benchmark (default: %s)' % ', '.join(f'{k} {v}' for k, v in BENCH_NODES.items())
+    )
+
+    grp_replay = parser.add_argument_group(title='Replay')
+
+    grp_replay.add_argument(
+        '--latency', type=float, default=0.0, metavar='<secs>',
+        help='Added latency per response (default: %(default)s)'
+    )
+    grp_replay.add_argument(
+        '--throttle-rate', type=float, default=0.0, metavar='<frac>',
+        help='Fraction of responses replaced by a 429 (default: %(default)s)'
+    )
+    grp_replay.add_argument(
+        '--partial-rate', type=float, default=0.0, metavar='<frac>',
+        help='Fraction of responses cut short of their Content-Length (default: %(default)s)'
+    )
+    grp_replay.add_argument(
+        '--replay', type=str, metavar='<file>',
+        help='Responses saved by --record to serve before synthetic ones'
+    )
+    grp_replay.add_argument(
+        '--record', type=str, metavar='<file>',
+        help='Scrape --user from instagram and save its responses to file instead of benchmarking'
+    )
+    grp_replay.add_argument(
+        '--user', type=str, default=BENCH_USER, metavar='<username>',
+        help='Account the scrape benchmark fetches, a recorded one to replay it (default: %(default)s)'
+    )
+
+    return parser.parse_args()
+
+ARGS = None
+if __name__ == '__main__':
+    ARGS = parse_args()
+
+
+import io
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.cookies import RequestsCookieJar
+
+import insta
+from insta import (
+    ENDPOINT_RATES, HTTP_CACHE_NAME, MAX_IMGS, SESSION_NAME, InstaGet, RateLimiter, ResponseCache, SessionManager, lo,
+    rank_media
+)
+
+BENCH_RATE = 1e6
+BENCH_NOW = 1600000000
+THUMB_BYTES = 20 * 1024
+PROFILE_EDGES = 12
+PAGE_SIZE = 50
+
+
+def make_node(i: int, now: int = BENCH_NOW) -> dict:
+    """Build a synthetic GraphQL timeline node shaped like the real ones."""
+    shortcode = f'B{i:010d}'
+    is_video = i % 5 == 0
+
+    return {
+        '__typename': 'GraphVideo' if is_video else 'GraphImage',
+        'id': str(2000000000000000000 + i),
+        'shortcode': shortcode,
+        'display_url': f'https://cdn.example.com/d/{shortcode}.jpg',
+        'thumbnail_src': f'https://cdn.example.com/t/{shortcode}.jpg',
+        'is_video': is_video,
+        'video_url': f'https://cdn.example.com/v/{shortcode}.mp4' if is_video and i % 3 else None,
+        'video_view_count': (i * 131) % 100000 if is_video else None,
+        'taken_at_timestamp': now - i * 3600,
+        'location': None,
+        'edge_media_preview_like': {'count': (i * 7919) % 250000},
+        'edge_media_to_caption': {'edges': [{'node': {'text': f'  Caption for post {i} #tag{i % 97}  '}}]},
+        'edge_media_to_comment': {'count': i % 300},
+        'dimensions': {'height': 1080, 'width': 1080},
+        'comments_disabled': False
+    }
+
+
+def make_edges(n: int) -> List[dict]:
+    return [{'node': make_node(i)} for i in range(n)]
+
+
+def make_response(request: requests.PreparedRequest, status: int, body: bytes, headers: Dict[str, str] = None) -> requests.Response:
+    resp = requests.Response()
+    resp.request = request
+    resp.url = request.url
+    resp.status_code = status
+    resp.reason = 'OK' if status < 400 else 'Error'
+    resp.headers.update(headers or {})
+    resp.raw = io.BytesIO(body)
+    resp.cookies = RequestsCookieJar()
+    resp.encoding = 'utf-8'
+    return resp
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serves instagram offline from recorded responses, falling back to a synthetic account of posts.
+
+    Mount it on InstaGet.session for https://. Faults are injected at random with the given rates.
+    """
+
+    def __init__(
+        self, posts: int = BENCH_NODES['scrape'], latency: float = 0.0, throttle_rate: float = 0.0, partial_rate: float = 0.0,
+        recordings: Dict[str, tuple] = None, thumb_bytes: int = THUMB_BYTES, seed: int = 0
+    ):
+        super().__init__()
+        self.posts = posts
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.partial_rate = partial_rate
+        self.recordings = recordings or {}
+        self.thumb = b'\xff\xd8\xff\xe0' + bytes(max(0, thumb_bytes - 4))
+
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.by_endpoint: Dict[str, int] = {}
+
+    @classmethod
+    def from_file(cls, filename: str, **kwargs) -> 'ReplayAdapter':
+        with open(filename, 'rb') as f:
+            return cls(recordings=pickle.load(f), **kwargs)
+
+    def _page(self, start: int, size: int) -> dict:
+        end = min(start + size, self.posts)
+        has_next = end < self.posts
+        return {
+            'count': self.posts,
+            'page_info': {'has_next_page': has_next, 'end_cursor': str(end) if has_next else None},
+            'edges': [{'node': make_node(i)} for i in range(start, end)]
+        }
+
+    def _synthetic(self, request: requests.PreparedRequest, endpoint: str) -> requests.Response:
+        parts = urlsplit(request.url)
+
+        if endpoint == 'graphql':
+            variables = json.loads(parse_qs(parts.query)['variables'][0])
+            data = {'data': {'user': {'edge_owner_to_timeline_media': self._page(int(variables.get('after') or 0), variables['first'])}}}
+            return make_response(request, 200, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+        if endpoint == 'details':
+            node = make_node(int(parts.path.split('/')[2][1:]))
+            node['location'] = {'id': '1', 'has_public_page': True, 'name': 'Somewhere', 'slug': 'somewhere'}
+            node['video_url'] = node['display_url'].replace('/d/', '/v/').replace('.jpg', '.mp4')
+            data = {'graphql': {'shortcode_media': node}}
+            return make_response(request, 200, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+        if endpoint.startswith('image:'):
+            # unique per url so the thumbnail store can't dedupe them
+            url = request.url.encode()
+            return make_response(request, 200, self.thumb[:4] + url + self.thumb[4 + len(url):], {'Content-Type': 'image/jpeg'})
+
+        if parts.path == '/':
+            resp = make_response(request, 200, b'<html></html>', {'Content-Type': 'text/html'})
+            resp.cookies.set('csrftoken', 'bench')
+            return resp
+
+        user = {
+            'biography': 'Synthetic account', 'full_name': 'Bench', 'id': '1', 'profile_pic_url_hd': '',
+            'edge_followed_by': {'count': 1000},
+            'edge_owner_to_timeline_media': self._page(0, PROFILE_EDGES)
+        }
+        shared_data = {'entry_data': {'ProfilePage': [{'graphql': {'user': user}}]}}
+        body = '<html><script type="text/javascript">window._sharedData = {};</script></html>'.format(json.dumps(shared_data))
+        return make_response(request, 200, body.encode(), {'Content-Type': 'text/html'})
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        endpoint = RateLimiter.classify(request.url)
+
+        with self._lock:
+            self.requests += 1
+            self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+            throttled = self.random.random() < self.throttle_rate
+            partial = self.random.random() < self.partial_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if throttled:
+            return make_response(request, 429, b'', {'Retry-After': '0'})
+
+        recorded = self.recordings.get(request.url)
+        if recorded is not None:
+            status, headers, body = recorded
+            resp = make_response(request, status, body, headers)
+        else:
+            resp = self._synthetic(request, endpoint)
+
+        body = resp.raw.getvalue()
+        resp.headers['Content-Length'] = str(len(body))
+        if partial and body:
+            resp.raw = io.BytesIO(body[:len(body) // 2])
+
+        return resp
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Passes requests through to the network and keeps every response for ReplayAdapter.from_file."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recordings: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, **kwargs):
+        resp = super().send(request, stream=False, **kwargs)
+
+        headers = {k: v for k, v in resp.headers.items() if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+        with self._lock:
+            self.recordings[request.url] = (resp.status_code, headers, resp.content)
+
+        return resp
+
+    def save(self, filename: str):
+        with open(filename, 'wb') as f:
+            pickle.dump(self.recordings, f)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux, and the high-water mark of the whole process,
+    # which is why main runs each benchmark in a process of its own
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_media(n: int, **_kw):
+    edges = make_edges(n)
+
+    start = time.perf_counter()
+    media = InstaGet.convert_nodes(edges)
+    elapsed = time.perf_counter() - start
+    del media
+
+    # only the objects built by convert_nodes are counted, the nodes already exist
+    tracemalloc.start()
+    media = InstaGet.convert_nodes(edges)
+    allocated, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'media: {n:,} nodes')
+    print(f'  {n / elapsed:,.0f} objects/sec ({elapsed:.3f}s)')
+    print(f'  {allocated / len(media):,.0f} bytes/object')
+
+
+def bench_scrape(
+    n: int, latency: float = 0.0, throttle_rate: float = 0.0, partial_rate: float = 0.0, replay: str = None,
+    user: str = BENCH_USER, **_kw
+):
+    kwargs = dict(posts=n, latency=latency, throttle_rate=throttle_rate, partial_rate=partial_rate)
+    if replay:
+        adapter = ReplayAdapter.from_file(replay, **kwargs)
+    else:
+        adapter = ReplayAdapter(**kwargs)
+
+    saved_dirs = insta.PICKLE_DIR, insta.THUMB_DIR, insta.TEMPLATE_DIR
+    insta.TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(insta.__file__)), insta.TEMPLATE_DIRNAME)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        insta.PICKLE_DIR = os.path.join(tmp, insta.PICKLE_DIRNAME)
+        insta.THUMB_DIR = os.path.join(tmp, insta.THUMB_DIRNAME)
+        os.makedirs(insta.THUMB_DIR)
+
+        try:
+            limiter = RateLimiter({k: BENCH_RATE for k in ENDPOINT_RATES})
+            scraper = InstaGet(rate_limiter=limiter)
+            scraper.session.mount('https://', adapter)
+
+            timings = {}
+
+            start = time.perf_counter()
+            data = scraper.scrape(
+                user, max_pages=math.ceil(n / PAGE_SIZE) + 1, max_images=MAX_IMGS, sync='full'
+            )
+            timings['scrape'] = time.perf_counter() - start
+            if data is None:
+                lo.e('Scrape returned no data')
+                return
+
+            prof, media = data
+            media_sort = rank_media(media, MAX_IMGS)
+
+            start = time.perf_counter()
+            scraper.save_all_media(media_sort)
+            timings['save_media'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            scraper.gen_html(prof, media_sort, 4, 'md')
+            timings['gen_html'] = time.perf_counter() - start
+
+            scraper.close_writer()
+
+        finally:
+            insta.PICKLE_DIR, insta.THUMB_DIR, insta.TEMPLATE_DIR = saved_dirs
+
+    print(f'scrape: {n:,} posts, {scraper.pages_fetched} pages')
+    for stage, secs in timings.items():
+        print(f'  {stage:<10} {secs:8.3f}s')
+    print(f'  {"total":<10} {sum(timings.values()):8.3f}s')
+    print(f'  {adapter.requests:,} requests (' + ', '.join(f'{k} {v:,}' for k, v in sorted(adapter.by_endpoint.items())) + ')')
+    print(f'  {peak_rss_mb():,.1f} MB peak RSS')
+
+
+def bench_html(n: int, **_kw):
+    media = InstaGet.convert_nodes(make_edges(n))
+    for i, m in enumerate(media):
+        if i % 2:
+            m.thumb_file = f'{insta.THUMB_DIR}{i:064x}.jpg'
+
+    saved_dir = insta.TEMPLATE_DIR
+    insta.TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(insta.__file__)), insta.TEMPLATE_DIRNAME)
+
+    try:
+        scraper = InstaGet()
+        scraper.user = 'bench'
+
+        start = time.perf_counter()
+        rows = InstaGet.html_rows(media)
+        rows_elapsed = time.perf_counter() - start
+        del rows
+
+        timings = {}
+        for paged in (False, True):
+            # the first render also compiles the templates
+            for run in ('cold', 'warm'):
+                start = time.perf_counter()
+                files = scraper.gen_html({}, media, 4, 'md', paged=paged)
+                timings[f'{"paged" if paged else "single"} {run}'] = (time.perf_counter() - start, sum(map(len, files.values())))
+
+    finally:
+        insta.TEMPLATE_DIR = saved_dir
+
+    print(f'html: {n:,} items')
+    print(f'  {"rows":<12} {rows_elapsed:8.3f}s ({n / rows_elapsed:,.0f} items/sec)')
+    for name, (secs, size) in timings.items():
+        print(f'  {name:<12} {secs:8.3f}s ({n / secs:,.0f} items/sec, {size / 1024 / 1024:,.1f} MB)')
+
+
+def record_user(filename: str, n: int, user: str):
+    """Scrape up to n posts of user over the network and save every response for --replay.
+
+    Uses the saved session, but a store and response cache of its own, so nothing cached is left out of the recording.
+    """
+    adapter = RecordingAdapter()
+    sessions = SessionManager(SESSION_NAME, transport=adapter)
+    sessions.load()
+
+    saved_dir = insta.PICKLE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        insta.PICKLE_DIR = os.path.join(tmp, insta.PICKLE_DIRNAME)
+
+        try:
+            scraper = InstaGet(
+                transport=adapter, sessions=sessions, http_cache=ResponseCache(os.path.join(tmp, HTTP_CACHE_NAME))
+            )
+            data = scraper.scrape(user, max_pages=math.ceil(n / PAGE_SIZE) + 1, max_images=MAX_IMGS, sync='full')
+            scraper.close_writer()
+        finally:
+            insta.PICKLE_DIR = saved_dir
+
+    if data is None:
+        lo.e(f'Scrape of {user} failed, nothing recorded')
+        return
+
+    sessions.save()
+    adapter.save(filename)
+    lo.s(f'Recorded {len(adapter.recordings):,} responses of {user} to {filename}, replay with --replay {filename} --user {user}')
+
+
+BENCHMARKS = {
+    'media': bench_media,
+    'scrape': bench_scrape,
+    'html': bench_html
+}
+
+
+def run_benchmark(name: str, n: int, log_level: str, kw: dict):
+    lo.set_level(log_level.upper())
+    BENCHMARKS[name](n, **kw)
+
+
+def main(benchmark: List[str], nodes: Optional[int], record: Optional[str], log_level: str, **kw):
+    lo.set_level(log_level.upper())
+
+    if record:
+        record_user(record, nodes or BENCH_NODES['scrape'], kw['user'])
+        return
+
+    names = benchmark or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            lo.e(f'Unknown benchmark: {name}')
+            continue
+
+        # memory left over from one benchmark would show up in the next one's peak
+        proc = multiprocessing.Process(target=run_benchmark, args=(name, nodes or BENCH_NODES[name], log_level, kw))
+        proc.start()
+        proc.join()
+        if proc.exitcode:
+            lo.e(f'Benchmark {name} failed with exit code {proc.exitcode}')
+
+if __name__ == '__main__':
+    dargs = vars(ARGS)
+    main(**dargs)
@@ -1,76 +1,279 @@
 #!/usr/bin/env python3
 
-import json
-import requests
-from time import sleep
-import sys
+"""Poll instagram accounts for the likes on their recent posts, keeping every observation."""
+
+__version__ = 1.1
+DEFAULT_LOGLEVEL = 'INFO'
+
+# timeline pages read per account and poll, the first is the 12 posts on the profile and the rest 50 each
+POLL_DEPTH = 2
+POLL_EVERY = 15
+POLL_COUNT = 1
+
+
+def parse_args():
+    from my_utils.parsing import parser_init
+
+    parser = parser_init(
+        description=__doc__,
+        usage='%(prog)s [options] username [...]',
+        log_level=DEFAULT_LOGLEVEL,
+        version=__version__
+    )
+
+    parser.add_argument(
+        'username', nargs='*', type=str,
+        help='Instagram usernames to poll'
+    )
+
+    grp_poll = parser.add_argument_group(title='Polling')
+
+    grp_poll.add_argument(
+        '-d', '--depth', type=int, default=POLL_DEPTH, metavar='<num>',
+        help='Timeline pages to read per account (default: %(default)d)'
+    )
+    grp_poll.add_argument(
+        '-c', '--count', type=int, default=POLL_COUNT, metavar='<num>',
+        help='Polls of every account, 0 to keep polling (default: %(default)d)'
+    )
+    grp_poll.add_argument(
+        '-e', '--every', type=float, default=POLL_EVERY, metavar='<mins>',
+        help='Minutes from the start of one poll to the next (default: %(default)s)'
+    )
+    grp_poll.add_argument(
+        '-u', '--user-workers', type=int, metavar='<num>',
+        help='Accounts to poll in parallel (default: as many as insta.py)'
+    )
+
+    grp_output = parser.add_argument_group(title='Output')
+
+    grp_output.add_argument(
+        '-H', '--history', type=str, metavar='<shortcode>',
+        help='Print the observations of a post instead of polling'
+    )
+
+    return parser.parse_args()
+
+ARGS = None
+if __name__ == '__main__':
+    ARGS = parse_args()
+
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import pytz
-#import re
-#import string
+from typing import List, Optional
+
+from insta import (
+    PICKLE_DIR, POOL_SLACK, SESSION_NAME, USER_WORKERS, InstaGet, Metrics, RateLimiter, ResponseCache, SessionManager, lo,
+    log_connection_stats, make_transport, open_sqlite
+)
+
+ENGAGEMENT_NAME = 'engagement.sqlite'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class EngagementStore:
+    """Append-only time series of engagement, one row per (shortcode, observed_at).
+
+    Rows are only ever inserted, triggers refuse updates and deletes. A post's series is read through
+    the primary key, an account's through the (user, observed_at) index.
+    """
 
-if len(sys.argv) < 2:
-    print('input insta name')
-    sys.exit()
+    def __init__(self, filename: str = None):
+        self.filename = filename or PICKLE_DIR + ENGAGEMENT_NAME
+        self.conn = open_sqlite(self.filename, shared=True)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS likes ('
+                'shortcode TEXT NOT NULL, observed_at INTEGER NOT NULL, user TEXT NOT NULL, taken_at INTEGER, '
+                'likes INTEGER, comments INTEGER, views INTEGER, PRIMARY KEY (shortcode, observed_at)) WITHOUT ROWID'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS likes_user ON likes (user, observed_at)')
+            for action in ('UPDATE', 'DELETE'):
+                self.conn.execute(
+                    f'CREATE TRIGGER IF NOT EXISTS likes_no_{action.lower()} BEFORE {action} ON likes '
+                    f"BEGIN SELECT RAISE(ABORT, 'likes are append-only'); END"
+                )
 
-name = sys.argv[1]
+        self._lock = threading.Lock()
 
-base_url = 'https://www.instagram.com'
+    @staticmethod
+    def observations(user: str, observed_at: int, edges: List[dict]) -> List[tuple]:
+        rows = []
+        for edge in edges:
+            node = edge.get('node', {})
+            shortcode = node.get('shortcode')
+            if not shortcode:
+                continue
 
-#valid_letters = re.compile(r'[^{}]'.format(string.punctuation + string.digits + string.letters + ' '))
-local_tz = pytz.timezone('America/New_York')
+            rows.append((
+                shortcode, observed_at, user, node.get('taken_at_timestamp'),
+                node.get('edge_media_preview_like', {}).get('count'), node.get('edge_media_to_comment', {}).get('count'),
+                node.get('video_view_count')
+            ))
 
-maxim = 199
-if len(sys.argv) > 2:
-    maxim = int(sys.argv[2])
+        return rows
 
-more = True
-maxid = None
+    def add(self, rows: List[tuple]) -> int:
+        """Insert observations, returning how many were new."""
+        with self._lock, self.conn:
+            return self.conn.executemany('INSERT OR IGNORE INTO likes VALUES (?, ?, ?, ?, ?, ?, ?)', rows).rowcount
 
-i = 0
+    def history(self, shortcode: str, since: int = 0) -> List[tuple]:
+        """(observed_at, likes, comments, views) of a post, oldest first."""
+        with self._lock:
+            return self.conn.execute(
+                'SELECT observed_at, likes, comments, views FROM likes WHERE shortcode = ? AND observed_at >= ? '
+                'ORDER BY observed_at', (shortcode, since)
+            ).fetchall()
 
-#print 'now|uploaded|likes|is_vid|code|caption|url'
+    def account(self, user: str, since: int = 0) -> List[tuple]:
+        """(observed_at, shortcode, likes, comments, views) of an account's posts, oldest first."""
+        with self._lock:
+            return self.conn.execute(
+                'SELECT observed_at, shortcode, likes, comments, views FROM likes WHERE user = ? AND observed_at >= ? '
+                'ORDER BY observed_at', (user, since)
+            ).fetchall()
 
-while more and i < maxim:
-    url = '{}/{}/?__a=1'.format(base_url, name)
-    if maxid:
-        url += '&max_id={}'.format(maxid)
-    
-    i += 1
+    def close(self):
+        self.conn.close()
 
-    q = requests.get(url)
-    if q.status_code != 200:
-        sleep(1)
-        continue
+
+def poll_account(scraper: InstaGet, store: EngagementStore, user: str, depth: int) -> dict:
+    """Observe the posts on the first depth pages of the user's timeline."""
+    lo.s(f'Polling {user}')
+    scraper.user = user
+
+    stats = {'user': user, 'status': 'failed', 'pages': 0, 'posts': 0, 'elapsed': 0.0}
+    start = time.perf_counter()
 
     try:
-        u = q.json().get('user', {}).get('media')
-    except:
-        sleep(1)
-        continue
-
-    p = u.get('page_info')
-    maxid = p.get('end_cursor')
-    more = p.get('has_next_page')
-
-    now_time = datetime.now(pytz.utc).astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S')
-    
-    n = u.get('nodes')
-    
-    for nn in n:
-        li = nn.get('likes', {}).get('count')
-        #im = nn.get('display_src')
-        is_vid = nn.get('is_video')
-        #ca = nn.get('caption', '').encode('utf-8')
-        code = nn.get('code', '')
-        da = nn.get('date')
-        
-        #ca_safe = valid_letters.sub('_', ca)
-
-        date_fmt = datetime.utcfromtimestamp(da).replace(tzinfo=pytz.utc).astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S')
-        
-        #print '{}|{}|{}|{}|{}|{}|{}'.format(now_time, date_fmt, li, is_vid, code, ca_safe, im)
-        print('{}|{}|{}|{}|{}'.format(now_time, date_fmt, li, is_vid, code))
-        
-    sleep(1)
+        if not scraper.authenticate():
+            return stats
+
+        with scraper.metrics.timer('profile', user=user):
+            shared_data = scraper.fetch_profile()
+        page_data = scraper.get_page_data(shared_data) if shared_data else None
+        if not isinstance(page_data, dict):
+            return stats
+
+        media = page_data['edge_owner_to_timeline_media']
+        rows = store.observations(user, int(time.time()), media.get('edges', []))
+        store.add(rows)
+        stats['posts'] += len(rows)
+        stats['pages'] += 1
+
+        page_info = media.get('page_info', {})
+        with scraper.metrics.timer('pages', user=user):
+            for data in scraper.iter_pages(
+                page_data['id'], depth - 1, page_info.get('end_cursor'), page_info.get('has_next_page', False)
+            ):
+                rows = store.observations(user, int(time.time()), data['edge_owner_to_timeline_media']['edges'])
+                store.add(rows)
+                stats['posts'] += len(rows)
+                stats['pages'] += 1
+
+        stats['status'] = 'ok'
+
+    except Exception as e:
+        lo.e(f'Poll failed for {user}: {repr(e)}')
+        stats['status'] = 'error'
+
+    finally:
+        stats['elapsed'] = time.perf_counter() - start
+
+    return stats
+
+
+def print_history(store: EngagementStore, shortcode: str):
+    rows = store.history(shortcode)
+    if not rows:
+        lo.w(f'No observations of {shortcode}')
+        return
+
+    print('observed|likes|comments|views')
+    for observed_at, likes, comments, views in rows:
+        print(f'{datetime.fromtimestamp(observed_at).strftime(TIME_FORMAT)}|{likes}|{comments}|{views}')
+
+
+def main(
+    username: List[str], depth: int, count: int, every: float, user_workers: Optional[int], history: Optional[str],
+    log_level: str, **_kw
+):
+    log_level = log_level.upper()
+    if log_level != DEFAULT_LOGLEVEL:
+        lo.set_level(log_level)
+
+    store = EngagementStore()
+
+    if history:
+        print_history(store, history)
+        store.close()
+        return
+
+    if not username:
+        lo.e('No username given.')
+        return
+
+    if depth < 1:
+        lo.w(f'Raising depth from {depth} to 1')
+        depth = 1
+
+    workers = max(1, min(user_workers or USER_WORKERS, len(username)))
+
+    # like main in insta.py, one scraper per worker sharing the pacing, session and connections,
+    # but without the response cache, every poll has to see current counts
+    rate_limiter = RateLimiter()
+    metrics = Metrics()
+    transport = make_transport(workers + POOL_SLACK)
+    sessions = SessionManager(SESSION_NAME, transport=transport)
+    sessions.load()
+    http_cache = ResponseCache(ttls={})
+    local = threading.local()
+
+    def run(user: str) -> dict:
+        scraper = getattr(local, 'scraper', None)
+        if scraper is None:
+            scraper = local.scraper = InstaGet(
+                rate_limiter=rate_limiter, http_cache=http_cache, transport=transport, metrics=metrics, sessions=sessions
+            )
+
+        return poll_account(scraper, store, user, depth)
+
+    polls = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                started = time.time()
+                all_stats = list(pool.map(run, username))
+                sessions.save()
+                polls += 1
+
+                for st in all_stats:
+                    lo.i(
+                        f'{st["user"]}: {st["status"]}, {st["posts"]:,} posts observed on {st["pages"]} pages '
+                        f'in {st["elapsed"]:.1f}s'
+                    )
+
+                if count and polls >= count:
+                    break
+
+                wait = started + every * 60 - time.time()
+                lo.i(f'Poll {polls} done, next in {max(0.0, wait) / 60:.1f} minutes')
+                if wait > 0:
+                    time.sleep(wait)
+
+    except KeyboardInterrupt:
+        lo.w(f'Stopped after {polls} polls')
+
+    finally:
+        store.close()
+
+    log_connection_stats(transport)
+    lo.s('Done')
 
+if __name__ == '__main__':
+    dargs = vars(ARGS)
+    main(**dargs)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""HTTP transports for the instagram scraper.
+
+Kept out of insta.py so runs that only render from the cache never import requests.
+"""
+
+import socket
+import threading
+from http.client import HTTPMessage
+from types import SimpleNamespace
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection
+from urllib3.poolmanager import pool_classes_by_scheme
+
+try:
+    import httpx
+except ImportError:  # --http2 falls back to the pooled requests transport
+    httpx = None
+
+# hosts with a connection pool, instagram and its image CDNs
+POOL_HOSTS = 10
+# idle seconds before keepalive probes on a pooled socket, and before the HTTP/2 client drops one
+KEEPALIVE_IDLE = 30
+KEEPALIVE_EXPIRY = 60
+
+
+class PooledAdapter(HTTPAdapter):
+    """requests transport with a pool of pool_size connections per host and TCP keepalive on pooled sockets.
+
+    One adapter can be mounted in every worker's session, so they share warm connections.
+    """
+
+    def __init__(self, pool_size: int):
+        # sockets connected by host, a pooled connection whose socket dropped connects again unnoticed by the pool
+        self.opened: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        super().__init__(pool_connections=POOL_HOSTS, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE))
+
+        super().init_poolmanager(connections, maxsize, block=block, socket_options=options, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting_pool(pool_cls) for scheme, pool_cls in pool_classes_by_scheme.items()
+        }
+
+    def _counting_pool(self, pool_cls):
+        """pool_cls with connections that count their socket connects in opened."""
+        adapter = self
+
+        class CountingConnection(pool_cls.ConnectionCls):
+            def connect(self):
+                super().connect()
+                with adapter._lock:
+                    adapter.opened[self.host] = adapter.opened.get(self.host, 0) + 1
+
+        return type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': CountingConnection})
+
+    def connection_stats(self) -> Dict[str, tuple]:
+        """(requests, sockets connected) by host."""
+        pools = self.poolmanager.pools
+        made = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                made[pool.host] = made.get(pool.host, 0) + pool.num_requests
+
+        with self._lock:
+            return {host: (count, self.opened.get(host, 0)) for host, count in made.items()}
+
+
+class _StreamReader:
+    """File-like body of an httpx response for requests.Response.raw, decoded and read as needed."""
+
+    def __init__(self, resp):
+        self.resp = resp
+        self.chunks = resp.iter_bytes()
+        self.buf = b''
+
+        # read by requests for Set-Cookie headers
+        msg = HTTPMessage()
+        for key, value in resp.headers.multi_items():
+            msg.add_header(key, value)
+        self._original_response = SimpleNamespace(msg=msg)
+
+    def read(self, amt: int = None, **_kw) -> bytes:
+        while amt is None or len(self.buf) < amt:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+
+        if amt is None:
+            data, self.buf = self.buf, b''
+        else:
+            data, self.buf = self.buf[:amt], self.buf[amt:]
+
+        return data
+
+    def close(self):
+        self.resp.close()
+
+
+class Http2Adapter(BaseAdapter):
+    """requests transport over an httpx connection pool, multiplexing requests to a host on one HTTP/2 connection."""
+
+    def __init__(self, pool_size: int):
+        super().__init__()
+        self.transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=pool_size * POOL_HOSTS, max_keepalive_connections=pool_size * POOL_HOSTS,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            )
+        )
+        self.stats: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        opened = []
+
+        def trace(event: str, _info):
+            if event == 'connection.connect_tcp.complete':
+                opened.append(event)
+
+        req = httpx.Request(
+            request.method, request.url, headers=list(request.headers.items()), content=request.body,
+            extensions={
+                'timeout': {'connect': connect_timeout, 'read': read_timeout, 'write': read_timeout, 'pool': connect_timeout},
+                'trace': trace
+            }
+        )
+
+        try:
+            resp = self.transport.handle_request(req)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        host = urlsplit(request.url).hostname
+        with self._lock:
+            counts = self.stats.setdefault(host, [0, 0])
+            counts[0] += 1
+            counts[1] += len(opened)
+
+        response = requests.Response()
+        response.status_code = resp.status_code
+        response.reason = resp.extensions.get('reason_phrase', b'').decode('latin-1')
+        response.headers = CaseInsensitiveDict(resp.headers.items())
+        response.raw = _StreamReader(resp)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        extract_cookies_to_jar(response.cookies, request, response.raw)
+
+        if not stream:
+            _ = response.content
+
+        return response
+
+    def close(self):
+        self.transport.close()
+
+    def connection_stats(self) -> Dict[str, tuple]:
+        with self._lock:
+            return {host: tuple(counts) for host, counts in self.stats.items()}